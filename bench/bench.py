@@ -0,0 +1,339 @@
+#!/usr/bin/env python2.7
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import server
+import shutil
+import socket
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import yaml
+import zipfile
+
+LOG = logging.getLogger()
+
+BASE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(BASE)
+SCENARIOS = ['full', 'noop', 'incremental', 'cleanup']
+ARCHIVES = {
+    'targz':  ('.tar.gz', 'w:gz'),
+    'tarbz2': ('.tar.bz2', 'w:bz2'),
+    'zip':    ('.zip', None),
+}
+BLOCK = ''.join(chr(i) for i in map(random.Random(0).getrandbits, [8] * 65536))
+
+
+def parse_args(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='happy sync benchmark against a local webhdfs server')
+    parser.add_argument('-p', '--profile', default='tiny',
+                        help='name of the source tree profile to generate')
+    parser.add_argument('-f', '--profile-file', default=os.path.join(BASE, 'profiles.yaml'),
+                        help='yaml file of source tree profiles')
+    parser.add_argument('-w', '--workers', default=[], type=int, action='append',
+                        help='number of fetch workers to benchmark (may be repeated)')
+    parser.add_argument('-r', '--repeat', default=3, type=int,
+                        help='number of times to repeat each scenario sequence')
+    parser.add_argument('-o', '--output',
+                        help='where to write benchmark results')
+    parser.add_argument('-b', '--baseline',
+                        help='earlier results to compare against')
+    parser.add_argument('-T', '--threshold', default=0.1, type=float,
+                        help='relative slowdown against the baseline reported as a regression')
+    parser.add_argument('-W', '--work-dir',
+                        help='directory to generate trees and sync into (default temporary)')
+    parser.add_argument('-k', '--keep', default=False, action='store_true',
+                        help='keep the work directory after finishing')
+    parser.add_argument('-a', '--happy-args', default=[], action='append',
+                        help='extra argument to pass to happy (may be repeated)')
+    parser.add_argument('-v', '--verbose', default=False, action='store_true',
+                        help='log debug messages')
+
+    return parser.parse_args(args)
+
+
+def write_file(path, size, rng, salt=''):
+    block = BLOCK[rng.randint(0, len(BLOCK) // 2):]
+    head = '%s:%s\n' % (path, salt)
+
+    with open(path, 'wb') as data:
+        data.write(head[:size])
+        left = size - min(size, len(head))
+        while left > 0:
+            data.write(block[:left])
+            left -= len(block[:left])
+
+
+def file_size(rng, sizes):
+    return int(min(sizes['max'], sizes['min'] * rng.paretovariate(sizes.get('shape', 1.5))))
+
+
+def make_dirs(root, conf, rng):
+    dirs = ['']
+    while len(dirs) < conf['dirs']:
+        parent = rng.choice(dirs)
+        if parent.count('/') < conf['depth']:
+            dirs.append('%s/d%03d' % (parent, len(dirs)))
+
+    for item in dirs:
+        if not os.path.exists(root + item):
+            os.makedirs(root + item)
+
+    return dirs
+
+
+def make_tree(root, conf, stamp):
+    rng = random.Random(conf.get('seed', 0))
+    dirs = make_dirs(root, conf, rng)
+    files = []
+
+    for i in xrange(conf['files']):
+        name = '%s/f%06d.dat' % (rng.choice(dirs), i)
+        write_file(root + name, file_size(rng, conf['sizes']), rng)
+        files.append(name)
+
+    for kind, count in sorted((conf.get('archives') or {}).items()):
+        suffix, mode = ARCHIVES[kind]
+        for i in xrange(count):
+            name = '%s/a%04d%s' % (rng.choice(dirs), i, suffix)
+            temp = tempfile.mkdtemp(dir=os.path.dirname(root))
+            for j in xrange(conf.get('members', 10)):
+                write_file('%s/m%04d.dat' % (temp, j), file_size(rng, conf['sizes']), rng)
+
+            if mode:
+                with tarfile.open(root + name, mode) as data:
+                    data.add(temp, arcname='.')
+            else:
+                with zipfile.ZipFile(root + name, 'w', zipfile.ZIP_DEFLATED) as data:
+                    for item in sorted(os.listdir(temp)):
+                        data.write(os.path.join(temp, item), item)
+            shutil.rmtree(temp)
+            files.append(name)
+
+    for path, subs, names in os.walk(root):
+        for item in names:
+            os.utime(os.path.join(path, item), (stamp, stamp))
+
+    LOG.info('generated %d files in %d directories under %s', len(files), len(dirs), root)
+    return rng, dirs, files
+
+
+def make_manifests(root, conf, dirs, files, rng, source, stamp):
+    check = []
+    for i, path in enumerate(rng.sample(dirs, min(len(dirs), conf.get('manifests', 0)))):
+        name = '%s/manifest.json' % path
+        data = dict((os.path.basename(j), {'size': os.path.getsize(root + j)}) for j in files if os.path.dirname(j) == path)
+        with open(root + name, 'w') as item:
+            json.dump({'files': data}, item)
+        os.utime(root + name, (stamp, stamp))
+        check.append({'hdfs_path': source + name, 'setup_cmd': 'true'})
+
+    return check
+
+
+def change_tree(root, conf, files, rng, stamp):
+    changed = rng.sample(files, int(len(files) * conf.get('change', 0)))
+    for item in changed:
+        write_file(root + item, os.path.getsize(root + item), rng, stamp)
+        os.utime(root + item, (stamp, stamp))
+
+    created = []
+    for i in xrange(int(len(files) * conf.get('create', 0))):
+        name = '%s/n%06d.dat' % (os.path.dirname(rng.choice(files)), i)
+        write_file(root + name, file_size(rng, conf['sizes']), rng)
+        os.utime(root + name, (stamp, stamp))
+        created.append(name)
+
+    touch_dirs(root, set(changed + created), stamp)
+    files.extend(created)
+    LOG.info('changed %d and created %d files', len(changed), len(created))
+
+
+def remove_tree(root, conf, files, rng, stamp):
+    removed = rng.sample(files, int(len(files) * conf.get('remove', 0)))
+    for item in removed:
+        os.unlink(root + item)
+        files.remove(item)
+
+    touch_dirs(root, set(removed), stamp)
+    LOG.info('removed %d files', len(removed))
+
+
+def touch_dirs(root, names, stamp):
+    for item in set(os.path.dirname(i) for i in names):
+        while True:
+            os.utime(root + item, (stamp, stamp))
+            if not item:
+                break
+            item = os.path.dirname(item).rstrip('/')
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def run_happy(work, url, workers, extra):
+    args = [
+        sys.executable, os.path.join(REPO, 'happy'),
+        '-u', url,
+        '-d', os.path.join(work, 'dest'),
+        '-t', os.path.join(work, 'temp'),
+        '-c', os.path.join(work, 'conf'),
+        '-l', 'file://%s?level=info' % os.path.join(work, 'happy.log'),
+        '-p', str(free_port()),
+        '-w', str(workers),
+    ] + extra
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.path.join(work, 'lib'), os.environ.get('PYTHONPATH')])))
+
+    start = time.time()
+    subprocess.check_call(args, env=env)
+    spent = time.time() - start
+
+    try:
+        with open(os.path.join(work, 'dest', '.happy.idx.json')) as data:
+            report = json.load(data)
+    except (IOError, ValueError) as e:
+        LOG.warning('no run report available: %s', e)
+        report = {}
+
+    return spent, report
+
+
+def run_sequence(work, conf, workers, extra):
+    root = os.path.join(work, 'remote', 'bench')
+    stamp = 1500000000
+    for item in ('remote', 'dest', 'temp', 'conf'):
+        shutil.rmtree(os.path.join(work, item), ignore_errors=True)
+        os.makedirs(os.path.join(work, item))
+
+    rng, dirs, files = make_tree(root, conf, stamp)
+    for i, item in enumerate(make_manifests(root, conf, dirs, files, rng, '/bench', stamp)):
+        with open(os.path.join(work, 'conf', 'bench%d_dataset.yaml' % i), 'w') as data:
+            yaml.safe_dump(item, data, default_flow_style=False)
+
+    hdfs = server.Server(os.path.join(work, 'remote'), latency=conf.get('latency', 0), bandwidth=conf.get('bandwidth', 0))
+    hdfs.start()
+
+    results = {}
+    try:
+        for name in SCENARIOS:
+            if name == 'incremental':
+                change_tree(root, conf, files, rng, stamp + 3600)
+            elif name == 'cleanup':
+                remove_tree(root, conf, files, rng, stamp + 7200)
+
+            hdfs.reset()
+            spent, report = run_happy(work, '%s/bench' % hdfs.url, workers, extra)
+            results[name] = {
+                'seconds': spent,
+                'requests': hdfs.reset(),
+                'phases': dict((k, v['seconds']) for k, v in report.get('phases', {}).items()),
+                'transfers': report.get('transfers', {}),
+            }
+            LOG.info('%s sync with %d workers took %.3fs', name, workers, spent)
+    finally:
+        hdfs.stop()
+
+    return results
+
+
+def median(items):
+    items = sorted(items)
+    return (items[(len(items) - 1) // 2] + items[len(items) // 2]) / 2.0
+
+
+def summarize(runs):
+    data = {}
+    for name in SCENARIOS:
+        items = list(i[name] for i in runs)
+        data[name] = {
+            'seconds': list(i['seconds'] for i in items),
+            'median': median(list(i['seconds'] for i in items)),
+            'best': min(i['seconds'] for i in items),
+            'phases': dict((k, median(list(i['phases'].get(k, 0) for i in items))) for k in set().union(*(i['phases'] for i in items))),
+            'requests': items[-1]['requests'],
+            'transfers': items[-1]['transfers'],
+        }
+
+    return data
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=REPO, stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    found = 0
+    print '%-8s %-12s %10s %10s %8s' % ('workers', 'scenario', 'baseline', 'current', 'change')
+    for workers, items in sorted(results['results'].items(), key=lambda i: int(i[0])):
+        for name in SCENARIOS:
+            if workers not in baseline['results'] or name not in baseline['results'][workers]:
+                continue
+
+            old = baseline['results'][workers][name]['median']
+            new = items[name]['median']
+            diff = (new - old) / old if old else 0
+            mark = ' REGRESSION' if diff > threshold else ''
+            found += bool(mark)
+            print '%-8s %-12s %9.3fs %9.3fs %+7.1f%%%s' % (workers, name, old, new, diff * 100, mark)
+
+    return found
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format='%(asctime)s %(levelname)8s: %(message)s')
+
+    with open(args.profile_file) as data:
+        conf = yaml.safe_load(data)[args.profile]
+
+    work = os.path.abspath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix='happy-bench-')
+    if not os.path.exists(os.path.join(work, 'lib')):
+        os.makedirs(os.path.join(work, 'lib'))
+        os.symlink(os.path.join(REPO, 'lib'), os.path.join(work, 'lib', 'happy'))
+
+    results = {
+        'profile': args.profile,
+        'settings': conf,
+        'revision': revision(),
+        'python': platform.python_version(),
+        'started': time.time(),
+        'results': {},
+    }
+
+    try:
+        for workers in args.workers or [4]:
+            runs = list(run_sequence(work, conf, workers, args.happy_args) for i in xrange(args.repeat))
+            results['results'][str(workers)] = summarize(runs)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work, ignore_errors=True)
+        else:
+            LOG.info('kept work directory: %s', work)
+
+    output = args.output or 'bench-%s-%s.json' % (args.profile, time.strftime('%Y%m%d%H%M%S'))
+    with open(output, 'w') as data:
+        json.dump(results, data, indent=2, sort_keys=True)
+    LOG.info('saved benchmark results: %s', output)
+
+    if args.baseline:
+        with open(args.baseline) as data:
+            if compare(results, json.load(data), args.threshold):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
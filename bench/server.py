@@ -0,0 +1,126 @@
+import BaseHTTPServer
+import hashlib
+import json
+import logging
+import os
+import SocketServer
+import threading
+import time
+import urllib
+import urlparse
+
+LOG = logging.getLogger()
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    _block_size = 64 * 1024
+    _prefix = '/webhdfs/v1'
+
+    def log_message(self, fmt, *args):
+        LOG.debug('%s - %s', self.client_address[0], fmt % args)
+
+    def reply(self, code, body='', kind='application/json', headers=()):
+        self.send_response(code)
+        self.send_header('Content-Type', kind)
+        self.send_header('Content-Length', str(len(body)))
+        for key, val in headers:
+            self.send_header(key, val)
+        self.end_headers()
+
+        rate = self.server.bandwidth
+        for i in xrange(0, len(body), self._block_size):
+            start = time.time()
+            self.wfile.write(body[i:i + self._block_size])
+            if rate:
+                time.sleep(max(0, float(len(body[i:i + self._block_size])) / rate - (time.time() - start)))
+
+    def error(self, code, kind, text):
+        self.reply(code, json.dumps({'RemoteException': {'exception': kind, 'message': text}}))
+
+    def status(self, full, name):
+        info = os.stat(full)
+        return {
+            'pathSuffix': name,
+            'type': 'DIRECTORY' if os.path.isdir(full) else 'FILE',
+            'length': 0 if os.path.isdir(full) else info.st_size,
+            'modificationTime': int(info.st_mtime * 1000),
+            'blockSize': 128 * 1024 * 1024,
+            'replication': 3,
+        }
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        args = dict(urlparse.parse_qsl(url.query))
+        path = urllib.unquote(url.path)
+
+        self.server.count(args.get('op'))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if not path.startswith(self._prefix):
+            return self.error(400, 'IllegalArgumentException', 'unsupported path: %s' % path)
+
+        full = os.path.normpath('%s/%s' % (self.server.root, path[len(self._prefix):]))
+        if not os.path.exists(full):
+            return self.error(404, 'FileNotFoundException', 'file does not exist: %s' % path[len(self._prefix):])
+
+        op = args.get('op', '').upper()
+        if op == 'LISTSTATUS':
+            return self.reply(200, json.dumps({'FileStatuses': {'FileStatus': list(self.status(os.path.join(full, i), i) for i in sorted(os.listdir(full)))}}))
+        elif op == 'GETFILESTATUS':
+            return self.reply(200, json.dumps({'FileStatus': self.status(full, '')}))
+        elif op == 'GETFILECHECKSUM':
+            with open(full, 'rb') as data:
+                digest = hashlib.md5(data.read()).hexdigest()
+            return self.reply(200, json.dumps({'FileChecksum': {'algorithm': 'MD5-of-0MD5-of-512CRC32C', 'bytes': digest, 'length': 28}}))
+        elif op == 'OPEN' and 'datanode' not in args:
+            return self.reply(307, headers=[('Location', '%s%s&datanode=true' % (self.server.url, self.path))])
+        elif op == 'OPEN':
+            offset = int(args.get('offset', 0))
+            with open(full, 'rb') as data:
+                data.seek(offset)
+                body = data.read(int(args['length'])) if 'length' in args else data.read()
+            return self.reply(200, body, 'application/octet-stream')
+
+        self.error(400, 'UnsupportedOperationException', 'unsupported operation: %s' % op)
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root, port=0, latency=0, bandwidth=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.root = root
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def count(self, op):
+        with self.lock:
+            self.stats[op] = self.stats.get(op, 0) + 1
+
+    def reset(self):
+        with self.lock:
+            stats, self.stats = self.stats, {}
+        return stats
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='webhdfs')
+        self.thread.daemon = True
+        self.thread.start()
+
+        LOG.info('serving %s over webhdfs at %s with %.3fs latency and %d B/s bandwidth', self.root, self.url, self.latency, self.bandwidth)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
@@ -0,0 +1,223 @@
+import errno
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+
+LOG = logging.getLogger()
+
+
+TAR_MODES = dict((k, v) for k, v in {
+    'targz':  'gz',
+    'tarxz':  'xz',
+    'tarbz2': 'bz2',
+}.items() if v in tarfile.TarFile.OPEN_METH)
+
+TAR_COMMANDS = {
+    'targz':  ['tar', '-xzf'],
+    'tarxz':  ['tar', '-xJf'],
+    'tarbz2': ['tar', '-xjf'],
+}
+
+
+def resolve(base, path, links):
+    if os.path.isabs(path):
+        return None
+
+    full = list(base)
+    for part in path.split(os.sep):
+        if part in ('', os.curdir):
+            continue
+        if part == os.pardir:
+            if not full:
+                return None
+            full.pop()
+        else:
+            full.append(part)
+
+        if os.sep.join(full) in links:
+            return None
+
+    return full
+
+
+def members(tar):
+    links = set()
+    for item in tar:
+        name = os.path.normpath(item.name)
+        parts = name.split(os.sep)
+        if os.path.isabs(name) or parts[0] == os.pardir:
+            LOG.warning('skipping archive member outside of unpack path: %s', item.name)
+        elif any(os.sep.join(parts[:i]) in links for i in xrange(1, len(parts))):
+            LOG.warning('skipping archive member below a symlink: %s', item.name)
+        elif item.isdev():
+            LOG.warning('skipping archive device member: %s', item.name)
+        elif item.issym() and resolve(parts[:-1], item.linkname, links) is None:
+            LOG.warning('skipping archive symlink pointing outside of unpack path: %s -> %s', item.name, item.linkname)
+        elif item.islnk() and resolve([], item.linkname, links) is None:
+            LOG.warning('skipping archive hardlink pointing outside of unpack path: %s -> %s', item.name, item.linkname)
+        else:
+            if item.issym():
+                links.add(name)
+            yield item
+
+
+def extract(kind, name, path):
+    if kind == 'unzip':
+        with zipfile.ZipFile(name) as data:
+            for item in data.infolist():
+                full = data.extract(item, path)
+                if item.external_attr >> 16 & 0777:
+                    os.chmod(full, item.external_attr >> 16 & 0777)
+    elif kind in TAR_MODES:
+        with tarfile.open(name, 'r:%s' % TAR_MODES[kind]) as data:
+            data.extractall(path, members=members(data))
+    else:
+        subprocess.check_call(TAR_COMMANDS[kind] + [name, '-C', path])
+
+
+def extract_temp(kind, name, temp):
+    path = tempfile.mkdtemp(dir=temp)
+    try:
+        extract(kind, name, path)
+        return path, None
+    except Exception as e:
+        shutil.rmtree(path, ignore_errors=True)
+        return None, '%s: %s' % (name, e)
+
+
+def stream(kind, temp):
+    if kind in TAR_COMMANDS:
+        return Stream(kind, temp)
+
+
+class Stream(object):
+    _block_size = 1024 * 1024
+
+    def __init__(self, kind, temp):
+        self.kind = kind
+        self.path = tempfile.mkdtemp(dir=temp)
+        self.fail = None
+
+        if kind in TAR_MODES:
+            read, write = os.pipe()
+            self.pipe = os.fdopen(write, 'wb')
+            self.proc = threading.Thread(target=self.run, args=(os.fdopen(read, 'rb'),))
+            self.proc.daemon = True
+            self.proc.start()
+        else:
+            self.proc = subprocess.Popen(TAR_COMMANDS[kind] + ['-', '-C', self.path], stdin=subprocess.PIPE)
+            self.pipe = self.proc.stdin
+
+        LOG.debug('streaming %s archive into temporary unpack path: %s', kind, self.path)
+
+    def run(self, data):
+        try:
+            with tarfile.open(fileobj=data, mode='r|%s' % TAR_MODES[self.kind]) as tar:
+                tar.extractall(self.path, members=members(tar))
+        except Exception as e:
+            self.fail = e
+        finally:
+            try:
+                while data.read(self._block_size):
+                    pass
+            finally:
+                data.close()
+
+    def write(self, data):
+        if self.fail is None:
+            try:
+                self.pipe.write(data)
+            except (IOError, OSError) as e:
+                if e.errno != errno.EPIPE:
+                    raise
+                self.fail = e
+
+    def wait(self):
+        try:
+            self.pipe.close()
+        except (IOError, OSError) as e:
+            self.fail = self.fail or e
+
+        if isinstance(self.proc, threading.Thread):
+            self.proc.join()
+        elif self.proc.wait():
+            self.fail = self.fail or subprocess.CalledProcessError(self.proc.returncode, TAR_COMMANDS[self.kind])
+
+    def close(self):
+        self.wait()
+        if self.fail is None:
+            return self.path
+
+        LOG.warning('failed to unpack %s archive while streaming, retrying from file: %s', self.kind, self.fail)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def abort(self):
+        self.fail = self.fail or IOError('stream aborted')
+        self.wait()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class UnpackPool(object):
+    def __init__(self, workers, temp, depth=None):
+        self.temp = temp
+        self.depth = depth or 2 * workers
+        self.procs = multiprocessing.Pool(processes=workers)
+        self.slots = threading.BoundedSemaphore(self.depth)
+        self.lock = threading.Condition()
+        self.reset()
+
+        LOG.info('started %d archive unpack processes', workers)
+
+    def submit(self, item):
+        if not self.slots.acquire(False):
+            LOG.info('unpack queue is full, waiting to submit: %s', item.fullname)
+            start = time.time()
+            self.slots.acquire()
+            with self.lock:
+                self.stats['waits'] += 1
+                self.stats['waited'] += time.time() - start
+
+        with self.lock:
+            self.stats['queued'] += 1
+
+        LOG.debug('queueing archive for unpack: %s', item.fullname)
+        self.procs.apply_async(extract_temp, (item.zip_kind, item.fullname, self.temp), callback=lambda done: self.finish(item, *done))
+
+    def finish(self, item, path, fail):
+        try:
+            if path:
+                item.unzip(self.temp, path)
+            else:
+                LOG.error('failed to unpack archive %s', fail)
+                with self.lock:
+                    self.stats['failed'] += 1
+        finally:
+            with self.lock:
+                self.stats['done'] += 1
+                self.lock.notify_all()
+            self.slots.release()
+
+    def pending(self):
+        return self.stats['queued'] - self.stats['done']
+
+    def reset(self):
+        self.stats = {'queued': 0, 'done': 0, 'failed': 0, 'waits': 0, 'waited': 0.0}
+
+    def wait(self):
+        with self.lock:
+            while self.stats['queued'] > self.stats['done']:
+                self.lock.wait()
+
+        LOG.info('unpacked %d archives with %d failures, waited %d times for %.1fs on a full unpack queue', self.stats['queued'] - self.stats['failed'], self.stats['failed'], self.stats['waits'], self.stats['waited'])
+        self.reset()
+
+    def close(self):
+        self.procs.close()
+        self.procs.join()
@@ -0,0 +1,480 @@
+import collections
+import copy
+import cPickle
+import datetime
+import httplib
+import json
+import logging
+import multiprocessing.pool
+import os
+import socket
+import sys
+import threading
+import time
+import urllib
+import urlparse
+
+LOG = logging.getLogger()
+
+
+def find_class(module, name):
+    if module.split('.')[0] == 'webhdfs':
+        return LegacyStat
+
+    __import__(module)
+    return getattr(sys.modules[module], name)
+
+
+def unpickle(data):
+    item = cPickle.Unpickler(data)
+    item.find_global = find_class
+    return item.load()
+
+
+class LegacyStat(object):
+    def __getattr__(self, name):
+        path = self.__dict__.get('path', '')
+        bits = self.__dict__.get('bits') or {}
+
+        if name == 'name':
+            return bits.get('pathSuffix', '')
+        if name == 'full':
+            return '%s/%s' % (path.rstrip('/'), bits['pathSuffix']) if bits.get('pathSuffix') else path
+        if name == 'size':
+            return bits['length']
+        if name == 'date':
+            return datetime.datetime.fromtimestamp(bits['modificationTime'] // 1000)
+        raise AttributeError(name)
+
+
+class RemoteFile(object):
+    __slots__ = ('full', 'size', 'mtime', 'kind')
+
+    def __init__(self, full, size, mtime, kind='FILE'):
+        self.full = full
+        self.size = size
+        self.mtime = mtime
+        self.kind = kind
+
+    def __getstate__(self):
+        return dict((k, getattr(self, k)) for k in self.__slots__)
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            state = dict(state[0] or {}, **state[1])
+        if 'date' in state:
+            state['mtime'] = time.mktime(state.pop('date').timetuple())
+
+        for key in self.__slots__:
+            setattr(self, key, state.get(key, 'FILE' if key == 'kind' else None))
+
+    @property
+    def date(self):
+        return datetime.datetime.fromtimestamp(self.mtime)
+
+    @property
+    def name(self):
+        return os.path.basename(self.full)
+
+    def is_dir(self):
+        return self.kind == 'DIRECTORY'
+
+
+class ConnectionPool(object):
+    def __init__(self, size=16, idle=30, wait=None):
+        self.size = size
+        self.idle = idle
+        self.wait = wait
+        self.lock = threading.Lock()
+        self.conns = {}
+        self.stats = {'created': 0, 'reused': 0, 'expired': 0}
+
+    def get(self, url):
+        key = (url.scheme, url.netloc)
+        with self.lock:
+            while self.conns.get(key):
+                conn, last = self.conns[key].pop()
+                if time.time() - last < self.idle:
+                    self.stats['reused'] += 1
+                    return conn, True
+
+                self.stats['expired'] += 1
+                conn.close()
+
+            self.stats['created'] += 1
+
+        if url.scheme == 'https':
+            return httplib.HTTPSConnection(url.hostname, url.port, timeout=self.wait), False
+        return httplib.HTTPConnection(url.hostname, url.port, timeout=self.wait), False
+
+    def put(self, url, conn):
+        key = (url.scheme, url.netloc)
+        with self.lock:
+            if len(self.conns.setdefault(key, [])) < self.size:
+                self.conns[key].append((conn, time.time()))
+                return
+
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            for conns in self.conns.values():
+                for conn, last in conns:
+                    conn.close()
+            self.conns = {}
+
+        LOG.info('opened %d connections, reused them %d times, expired %d idle', self.stats['created'], self.stats['reused'], self.stats['expired'])
+
+
+class Transfer(object):
+    def __init__(self, client, path, part, offset, length, done, resp):
+        self.client = client
+        self.path = path
+        self.part = part
+        self.offset = offset
+        self.length = length
+        self.first = done
+        self.done = done
+        self.resp = resp
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.hedged = False
+        self.finished = False
+        self.won = False
+
+    @property
+    def rate(self):
+        spent = time.time() - self.start
+        return (self.done - self.first) / spent if spent > 0 else 0
+
+    def cancel(self):
+        try:
+            self.resp.conn.sock.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, socket.error) as e:
+            LOG.debug('failed to interrupt straggling transfer of %s: %s', self.path, e)
+
+
+class Hedger(object):
+    _block_size = 1024 * 1024
+    _samples = 256
+
+    def __init__(self, limit=2, factor=4, after=30, interval=1):
+        self.slots = threading.BoundedSemaphore(max(1, limit))
+        self.factor = float(factor)
+        self.after = after
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.active = set()
+        self.rates = collections.deque(maxlen=self._samples)
+        self.stats = {'started': 0, 'won': 0, 'lost': 0, 'failed': 0}
+        self.closed = threading.Event()
+        self.thread = None
+
+    def track(self, client, path, part, offset, length, done, resp):
+        task = Transfer(client, path, part, offset, length, done, resp)
+        with self.lock:
+            self.active.add(task)
+            if not self.thread:
+                self.thread = threading.Thread(target=self.watch, name='hedger')
+                self.thread.daemon = True
+                self.thread.start()
+        return task
+
+    def finish(self, task):
+        with task.lock:
+            task.finished = True
+        with self.lock:
+            self.active.discard(task)
+            if task.done > task.first:
+                self.rates.append(task.rate)
+
+    def median(self):
+        rates = sorted(list(self.rates) + list(i.rate for i in self.active))
+        return rates[len(rates) // 2] if len(rates) >= 3 else None
+
+    def watch(self):
+        while not self.closed.wait(self.interval):
+            with self.lock:
+                median = self.median()
+                slow = list(i for i in self.active if not i.hedged and time.time() - i.start > self.after and i.done < i.length)
+
+            for task in slow:
+                if median and task.rate * self.factor < median and self.slots.acquire(False):
+                    LOG.warning('hedging straggling transfer of %s at %.1f KiB/s against median %.1f KiB/s', task.path, task.rate / 1024, median / 1024)
+                    task.hedged = True
+                    with self.lock:
+                        self.stats['started'] += 1
+
+                    item = threading.Thread(target=self.hedge, args=(task,), name='hedge')
+                    item.daemon = True
+                    item.start()
+
+    def hedge(self, task):
+        try:
+            done = task.done
+            resp = task.client.open(task.path, task.offset + done, task.length - done)
+            try:
+                with open(task.part.name, 'r+b') as data:
+                    data.seek(task.offset + done)
+                    while done < task.length and not task.finished:
+                        block = resp.read(min(self._block_size, task.length - done))
+                        if not block:
+                            break
+                        data.write(block)
+                        done += len(block)
+
+                        if task.client.meter:
+                            task.client.meter.consume(len(block))
+
+                    if done == task.length:
+                        task.part.save(data, task.offset, done)
+                        with task.lock:
+                            task.won = not task.finished
+                            if task.won:
+                                task.cancel()
+            finally:
+                task.client.release(resp)
+                if resp.slot:
+                    resp.slot.release()
+
+            if task.won:
+                LOG.info('hedged request finished first for %s range %d+%d', task.path, task.offset, task.length)
+            with self.lock:
+                self.stats['won' if task.won else 'lost'] += 1
+        except Exception as e:
+            LOG.debug('hedged request for %s failed: %s', task.path, e)
+            with self.lock:
+                self.stats['failed'] += 1
+        finally:
+            self.slots.release()
+
+    def close(self):
+        self.closed.set()
+        if self.thread:
+            self.thread.join()
+
+    def report(self):
+        LOG.info('started %d hedged requests for straggling transfers, %d won, %d lost, %d failed', self.stats['started'], self.stats['won'], self.stats['lost'], self.stats['failed'])
+
+
+class HDFSClient(object):
+    _block_size = 1024 * 1024
+    _redirects = 4
+    _save_size = 64 * 1024 * 1024
+
+    def __init__(self, url, user, wait, size=0, workers=1, limit=1, hosts=0, meter=None, pool=None, hedge=None):
+        self.url = urlparse.urlparse(url)
+        self.user = user
+        self.wait = wait
+        self.size = size
+        self.workers = max(1, workers)
+        self.limit = threading.BoundedSemaphore(max(1, limit))
+        self.hosts = hosts
+        self.slots = {}
+        self.lock = threading.Lock()
+        self.meter = meter
+        self.pool = pool or ConnectionPool(wait=wait)
+        self.hedge = hedge
+
+    def clone(self, url):
+        item = copy.copy(self)
+        item.url = urlparse.urlparse(url)
+        return item
+
+    def slot(self, host):
+        if not self.hosts:
+            return None
+
+        with self.lock:
+            if host not in self.slots:
+                self.slots[host] = threading.BoundedSemaphore(self.hosts)
+            return self.slots[host]
+
+    def split(self, size):
+        return self.size > 0 and size > self.size
+
+    def layout(self, size):
+        return self.size if self.split(size) else 0
+
+    def ranges(self, size):
+        step = self.layout(size) or size
+        return list((i, min(step, size - i)) for i in xrange(0, size, step or 1))
+
+    def request(self, url):
+        while True:
+            conn, reused = self.pool.get(url)
+            try:
+                conn.request('GET', urlparse.urlunparse(('', '') + url[2:]))
+                resp = conn.getresponse()
+                resp.conn = conn
+                resp.url = url
+                return resp
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not reused:
+                    raise
+                LOG.debug('retrying request on stale pooled connection to %s', url.netloc)
+
+    def release(self, resp):
+        if resp.isclosed() and not resp.will_close:
+            self.pool.put(resp.url, resp.conn)
+        else:
+            resp.conn.close()
+
+    def target(self, op, path, **args):
+        args.update({'op': op, 'user.name': self.user})
+        return self.url._replace(path='/webhdfs/v1%s' % urllib.quote(path), query=urllib.urlencode(args))
+
+    def query(self, op, path, **args):
+        url = self.target(op, path, **args)
+        for i in xrange(self._redirects):
+            resp = self.request(url)
+            try:
+                data = resp.read()
+            finally:
+                self.release(resp)
+
+            if resp.status in (httplib.TEMPORARY_REDIRECT, httplib.FOUND, httplib.SEE_OTHER):
+                url = urlparse.urlparse(resp.getheader('location'))
+                LOG.debug('redirected %s %s to %s', op, path, url.netloc)
+            elif resp.status == httplib.OK:
+                return json.loads(data)
+            else:
+                try:
+                    fail = json.loads(data)['RemoteException']['message']
+                except (KeyError, TypeError, ValueError):
+                    fail = resp.reason
+                raise RuntimeError('%s: unexpected response %d %s' % (path, resp.status, fail))
+
+        raise RuntimeError('%s: too many redirects' % path)
+
+    def item(self, path, bits):
+        full = '%s/%s' % (path.rstrip('/'), bits['pathSuffix']) if bits['pathSuffix'] else path
+        return RemoteFile(full, bits['length'], bits['modificationTime'] // 1000, bits['type'])
+
+    def stat(self, path):
+        return self.item(path, self.query('GETFILESTATUS', path)['FileStatus'])
+
+    def checksum(self, path):
+        data = self.query('GETFILECHECKSUM', path)['FileChecksum']
+        return '%s:%s' % (data['algorithm'], data['bytes'])
+
+    def ls(self, path):
+        return list(self.item(path, i) for i in self.query('LISTSTATUS', path)['FileStatuses']['FileStatus'])
+
+    def open(self, path, offset=0, length=None):
+        args = {'offset': offset}
+        if length is not None:
+            args['length'] = length
+
+        url = self.target('OPEN', path, **args)
+        slot = None
+        for i in xrange(self._redirects):
+            if i:
+                slot = self.slot(url.netloc)
+                if slot and not slot.acquire(False):
+                    LOG.debug('waiting for connection slot to %s', url.netloc)
+                    slot.acquire()
+
+            try:
+                resp = self.request(url)
+            except Exception:
+                if slot:
+                    slot.release()
+                raise
+
+            if resp.status in (httplib.TEMPORARY_REDIRECT, httplib.FOUND, httplib.SEE_OTHER):
+                url = urlparse.urlparse(resp.getheader('location'))
+                resp.read()
+                self.release(resp)
+                if slot:
+                    slot.release()
+                    slot = None
+                LOG.debug('redirected %s range %d+%s to %s', path, offset, length, url.netloc)
+            elif resp.status == httplib.OK:
+                resp.slot = slot
+                return resp
+            else:
+                resp.read()
+                self.release(resp)
+                if slot:
+                    slot.release()
+                raise RuntimeError('%s: unexpected response %d %s' % (path, resp.status, resp.reason))
+
+        raise RuntimeError('%s: too many redirects' % path)
+
+    def read(self, path, part, offset, length, done=0, split=False, sink=None):
+        if split:
+            self.limit.acquire()
+
+        try:
+            resp = self.open(path, offset + done, length - done)
+            task = self.hedge.track(self, path, part, offset, length, done, resp) if self.hedge else None
+            try:
+                with open(part.name, 'r+b') as data:
+                    data.seek(offset + done)
+                    mark = done
+                    try:
+                        while done < length:
+                            block = resp.read(min(self._block_size, length - done))
+                            if not block:
+                                break
+                            data.write(block)
+                            done += len(block)
+
+                            if task:
+                                task.done = done
+
+                            if self.meter:
+                                self.meter.consume(len(block))
+
+                            if sink:
+                                sink.write(block)
+
+                            if done - mark >= self._save_size:
+                                part.save(data, offset, done)
+                                mark = done
+                    except (socket.error, httplib.HTTPException):
+                        if not task or not task.won:
+                            raise
+                    finally:
+                        if task:
+                            self.hedge.finish(task)
+                            if task.won:
+                                done = length
+                        part.save(data, offset, done)
+            finally:
+                if task and task.won:
+                    resp.conn.close()
+                else:
+                    self.release(resp)
+                if resp.slot:
+                    resp.slot.release()
+        finally:
+            if split:
+                self.limit.release()
+
+        if task and task.won and sink:
+            sink.abort()
+
+        if done != length:
+            raise IOError('%s: short read at offset %d (expected: %d bytes, observed: %d bytes)' % (path, offset, length, done))
+
+        LOG.debug('fetched %s range %d+%d', path, offset, length)
+        return done
+
+    def fetch(self, path, part, sink=None):
+        split = self.split(part.size)
+        todo = list((i, j, part.written.get(i, 0)) for i, j in self.ranges(part.size) if part.written.get(i, 0) < j)
+        if not todo:
+            return 0
+        if not split:
+            return self.read(path, part, *todo[0], sink=sink)
+
+        pool = multiprocessing.pool.ThreadPool(processes=min(self.workers, len(todo)))
+        try:
+            LOG.debug('fetching %s in %d ranges of %d bytes', path, len(todo), self.size)
+            return sum(pool.map(lambda i: self.read(path, part, *i, split=split), todo))
+        finally:
+            pool.close()
+            pool.join()
@@ -0,0 +1,104 @@
+import BaseHTTPServer
+import json
+import logging
+import signal
+import threading
+import time
+import urlparse
+
+import happy
+
+LOG = logging.getLogger()
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, fmt, *args):
+        LOG.debug('status request from %s: %s', self.client_address[0], fmt % args)
+
+    def reply(self, code, data):
+        body = json.dumps(data, indent=2, sort_keys=True)
+
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path in ('/', '/status'):
+            self.reply(200, self.server.daemon.status())
+        else:
+            self.reply(404, {'error': 'unknown path: %s' % url.path})
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        if url.path == '/sync':
+            full = urlparse.parse_qs(url.query).get('full', ['0'])[0].lower() in ('1', 'true', 'yes')
+            self.server.daemon.trigger(full, 'request from %s' % self.client_address[0])
+            self.reply(202, self.server.daemon.status())
+        else:
+            self.reply(404, {'error': 'unknown path: %s' % url.path})
+
+
+class Daemon(object):
+    def __init__(self, runner, sock, interval):
+        self.runner = runner
+        self.interval = interval
+        self.wake = threading.Event()
+        self.full = False
+        self.stopped = False
+        self.next = None
+
+        sock.listen(16)
+        self.server = BaseHTTPServer.HTTPServer(sock.getsockname(), Handler, bind_and_activate=False)
+        self.server.socket.close()
+        self.server.socket = sock
+        self.server.daemon = self
+
+    def status(self):
+        data = self.runner.status()
+        data['next'] = self.next
+        data['interval'] = self.interval
+        return data
+
+    def trigger(self, full=False, reason='trigger'):
+        LOG.info('%s sync cycle requested by %s', 'full' if full else 'incremental', reason)
+        self.full = self.full or full
+        self.wake.set()
+
+    def signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.trigger(False, 'SIGHUP')
+        elif signum == signal.SIGUSR1:
+            self.trigger(True, 'SIGUSR1')
+        else:
+            LOG.info('stopping after current sync cycle on signal %d', signum)
+            self.stopped = True
+            self.wake.set()
+
+    def run(self):
+        for item in (signal.SIGHUP, signal.SIGUSR1, signal.SIGTERM, signal.SIGINT):
+            signal.signal(item, self.signal)
+
+        serve = threading.Thread(target=self.server.serve_forever, name='status')
+        serve.daemon = True
+        serve.start()
+        LOG.info('serving status on http://%s:%d/status, running sync cycles every %ds', self.server.server_address[0], self.server.server_address[1], self.interval)
+
+        try:
+            while not self.stopped:
+                full, self.full = self.full, False
+                self.wake.clear()
+                try:
+                    self.runner.run(full)
+                except Exception as e:
+                    happy.log_error(e, 'sync cycle failed')
+
+                self.next = time.time() + self.interval
+                while not self.stopped and not self.wake.is_set() and time.time() < self.next:
+                    self.wake.wait(min(1, self.next - time.time()))
+        finally:
+            self.server.shutdown()
+            self.runner.close()
+            LOG.info('stopped after %d sync cycles', self.runner.cycles)
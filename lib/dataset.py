@@ -0,0 +1,88 @@
+import datetime
+import logging
+import multiprocessing.pool
+import os
+import threading
+import time
+
+LOG = logging.getLogger()
+
+
+class Datasets(object):
+    def __init__(self, check, local, index, workers=1, timeout=0, skip=False, scan=1):
+        self.check = check
+        self.local = local
+        self.index = index
+        self.timeout = timeout
+        self.skip = skip
+        self.scan = scan
+        self.lock = threading.Lock()
+        self.pending = dict((i, 0) for i in check)
+        self.listed = False
+        self.fired = set()
+        self.procs = multiprocessing.pool.ThreadPool(processes=max(1, workers))
+        self.stats = {'passed': 0, 'failed': 0}
+
+    def owners(self, key):
+        return list(i for i in self.check if key.startswith('%s/' % os.path.dirname(i)))
+
+    def add(self, key):
+        with self.lock:
+            for item in self.owners(key):
+                self.pending[item] += 1
+
+    def done(self, key, ok=True):
+        with self.lock:
+            if not ok:
+                for item in self.owners(key):
+                    if item not in self.fired:
+                        LOG.warning('dataset file failed to fetch, skipping checks until next run: %s', item)
+                        self.fired.add(item)
+            ready = list(i for i in self.owners(key) if self.decrement(i))
+        for item in ready:
+            self.fire(item)
+
+    def decrement(self, item):
+        self.pending[item] -= 1
+        return self.listed and not self.pending[item]
+
+    def finish(self):
+        with self.lock:
+            self.listed = True
+            ready = list(i for i, j in self.pending.items() if not j)
+        for item in ready:
+            self.fire(item)
+
+    def fire(self, item):
+        with self.lock:
+            if item in self.fired:
+                return
+            self.fired.add(item)
+
+        if item not in self.local:
+            LOG.warning('dataset manifest is not available locally, skipping: %s', item)
+            return
+
+        LOG.debug('all files of dataset are in place, queueing checks: %s', item)
+        self.procs.apply_async(self.run, (item,))
+
+    def run(self, item):
+        key = 'check:%s' % item
+        last = float(self.index.get(key, self.index.get('saved', time.mktime(datetime.datetime.min.timetuple()))))
+        start = time.time()
+
+        if self.local[item].check(self.check[item], last, self.skip, self.scan, self.timeout) is True:
+            self.index.set(key, repr(start))
+            with self.lock:
+                self.stats['passed'] += 1
+        else:
+            LOG.warning('dataset setup failed, will retry on next run: %s', item)
+            self.index.set(key, repr(last))
+            with self.lock:
+                self.stats['failed'] += 1
+
+    def close(self):
+        self.procs.close()
+        self.procs.join()
+
+        LOG.info('processed %d datasets with %d failures', self.stats['passed'] + self.stats['failed'], self.stats['failed'])
@@ -0,0 +1,170 @@
+import errno
+import happy.client
+import happy.syncer
+import logging
+import os
+import sqlite3
+import threading
+
+LOG = logging.getLogger()
+
+
+class Index(object):
+    _magic = 'SQLite format 3\x00'
+    _schema = [
+        'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER NOT NULL, date REAL NOT NULL, checksum TEXT)',
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+    ]
+
+    def __init__(self, name, skip=False):
+        self.name = name
+        self.skip = skip
+        self.lock = threading.Lock()
+        self.data = None
+        self.db = None
+
+        if self.legacy():
+            self.migrate()
+
+        if self.data is None and (not skip or os.path.exists(name)):
+            self.db = self.connect(name)
+
+    def legacy(self):
+        try:
+            with open(self.name, 'rb') as data:
+                return data.read(len(self._magic)) not in ('', self._magic)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+
+    def connect(self, name):
+        db = sqlite3.connect(name, check_same_thread=False, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        for item in self._schema:
+            db.execute(item)
+        if 'checksum' not in list(i[1] for i in db.execute('PRAGMA table_info(files)')):
+            db.execute('ALTER TABLE files ADD COLUMN checksum TEXT')
+
+        LOG.debug('opened local index: %s', name)
+        return db
+
+    def migrate(self):
+        LOG.warning('migrating legacy pickled index: %s', self.name)
+        try:
+            data = happy.client.unpickle(open(self.name, 'rb'))
+        except Exception as e:
+            happy.log_error(e, 'failed to load legacy index %s (%s), performing full fetch' % (self.name, type(e).__name__))
+            if self.skip:
+                self.data = {}
+            else:
+                os.rename(self.name, '%s.legacy' % self.name)
+                LOG.warning('moved unreadable legacy index aside: %s.legacy', self.name)
+            return
+
+        if self.skip:
+            self.data = data
+            return
+
+        temp = '%s.tmp' % self.name
+        if os.path.exists(temp):
+            os.unlink(temp)
+
+        db = self.connect(temp)
+        with db:
+            db.execute('BEGIN')
+            db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', (self.row(i) for i in data.values()))
+            db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('saved', repr(os.stat(self.name).st_mtime)))
+        db.close()
+
+        os.rename(temp, self.name)
+        LOG.info('migrated %d items from legacy index: %s', len(data), self.name)
+
+    def row(self, item):
+        return (item.remote.full, item.remote.size, item.remote.mtime, item.checksum)
+
+    def load(self, source, mirror, unpack):
+        if self.data is not None:
+            return self.data
+
+        if self.db is None:
+            raise IOError(errno.ENOENT, 'no such index', self.name)
+
+        with self.lock:
+            rows = self.db.execute('SELECT path, size, date, checksum FROM files').fetchall()
+
+        return dict((p, happy.syncer.SyncFile(happy.client.RemoteFile(p, s, d), source, mirror, unpack, c)) for p, s, d, c in rows)
+
+    def put(self, item):
+        if self.skip:
+            return
+
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', self.row(item))
+
+    def delete(self, key):
+        if self.skip:
+            return
+
+        with self.lock:
+            self.db.execute('DELETE FROM files WHERE path = ?', (key,))
+
+    def get(self, key, default=None):
+        if self.db is None:
+            return default
+
+        with self.lock:
+            data = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return data[0] if data else default
+
+    def set(self, key, value):
+        if self.skip:
+            return
+
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def close(self):
+        if self.db is not None:
+            with self.lock:
+                count = self.db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+                self.db.close()
+                self.db = None
+            LOG.info('closed index containing %d items: %s', count, self.name)
+
+
+class ContentIndex(object):
+    def __init__(self, items=()):
+        self.lock = threading.Lock()
+        self.items = {}
+        self.stats = {'files': 0, 'bytes': 0}
+
+        for item in items:
+            self.add(item)
+
+    def add(self, item):
+        if item.remote.size:
+            with self.lock:
+                self.items.setdefault((item.remote.size, item.remote.mtime), []).append(item)
+
+    def candidates(self, item):
+        with self.lock:
+            return any(i.checksum and i.remote.full != item.remote.full for i in self.items.get((item.remote.size, item.remote.mtime), []))
+
+    def find(self, item):
+        if not item.checksum:
+            return None
+
+        with self.lock:
+            for other in self.items.get((item.remote.size, item.remote.mtime), []):
+                if other.remote.full != item.remote.full and other.checksum == item.checksum:
+                    return other
+
+    def saved(self, item):
+        with self.lock:
+            self.stats['files'] += 1
+            self.stats['bytes'] += item.remote.size
+
+    def report(self):
+        LOG.info('reused %d identical local copies, saving %d bytes of transfer', self.stats['files'], self.stats['bytes'])
@@ -1,4 +1,5 @@
 import logging
+import logging.handlers
 import os
 import socket
 import traceback
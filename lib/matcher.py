@@ -0,0 +1,36 @@
+import fnmatch
+import logging
+import re
+
+LOG = logging.getLogger()
+
+
+class Matcher(object):
+    _wildcards = re.compile(r'[*?[]')
+
+    def __init__(self, globs):
+        self.globs = sorted(set(globs))
+        self.regex = re.compile('|'.join('(?:%s)' % fnmatch.translate(i) for i in self.globs)) if self.globs else None
+        self.trie = {}
+
+        for glob in self.globs:
+            node = self.trie
+            for char in self._wildcards.split(glob, 1)[0]:
+                node = node.setdefault(char, {})
+            node[None] = True
+
+        LOG.debug('compiled %d file globs', len(self.globs))
+
+    def match(self, path):
+        return self.regex is not None and self.regex.match(path) is not None
+
+    def prune(self, path):
+        node = self.trie
+        for char in '%s/' % path:
+            if None in node:
+                return False
+            if char not in node:
+                return True
+            node = node[char]
+
+        return False
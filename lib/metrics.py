@@ -0,0 +1,141 @@
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+LOG = logging.getLogger()
+
+
+class Metrics(object):
+    def __init__(self, name, interval=1):
+        self.name = name
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.counts = {}
+        self.files = []
+        self.gauges = {}
+        self.probes = {}
+        self.interval = interval
+        self.closed = threading.Event()
+        self.thread = None
+
+        if interval:
+            self.thread = threading.Thread(target=self.watch, name='metrics')
+            self.thread.daemon = True
+            self.thread.start()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.spent(name, time.time() - start, start)
+
+    def spent(self, name, secs, start=None):
+        with self.lock:
+            item = self.phases.setdefault(name, {'offset': (start or time.time()) - self.start, 'seconds': 0.0})
+            item['seconds'] += secs
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def file(self, path, size, secs):
+        with self.lock:
+            self.files.append((path, size, secs))
+
+    def probe(self, name, func, limit=None):
+        with self.lock:
+            self.probes[name] = (func, limit)
+            self.gauges[name] = {'samples': 0, 'total': 0.0, 'max': 0, 'limit': limit}
+
+    def sample(self):
+        with self.lock:
+            for name, (func, limit) in self.probes.items():
+                try:
+                    value = func()
+                except Exception as e:
+                    LOG.debug('failed to sample %s: %s', name, e)
+                    continue
+
+                item = self.gauges[name]
+                item['samples'] += 1
+                item['total'] += value
+                item['max'] = max(item['max'], value)
+
+    def watch(self):
+        while not self.closed.wait(self.interval):
+            self.sample()
+
+    def report(self):
+        with self.lock:
+            spent = time.time() - self.start
+            files = list({'path': p, 'bytes': s, 'seconds': round(t, 3), 'rate': s / t if t > 0 else None} for p, s, t in self.files)
+            gauges = dict((k, {
+                'mean': v['total'] / v['samples'] if v['samples'] else 0,
+                'max': v['max'],
+                'utilisation': v['total'] / v['samples'] / v['limit'] if v['samples'] and v['limit'] else None,
+            }) for k, v in self.gauges.items())
+
+            return {
+                'index': self.name,
+                'started': self.start,
+                'seconds': spent,
+                'phases': dict((k, dict(v)) for k, v in self.phases.items()),
+                'counts': dict(self.counts),
+                'gauges': gauges,
+                'transfers': {
+                    'files': len(files),
+                    'bytes': sum(i['bytes'] for i in files),
+                    'seconds': sum(i['seconds'] for i in files),
+                },
+                'files': files,
+            }
+
+    def prometheus(self, data):
+        label = 'index="%s"' % data['index'].replace('\\', '\\\\').replace('"', '\\"')
+        lines = []
+
+        def metric(name, kind, text, values):
+            lines.append('# HELP happy_%s %s' % (name, text))
+            lines.append('# TYPE happy_%s %s' % (name, kind))
+            for extra, value in values:
+                lines.append('happy_%s{%s} %s' % (name, ','.join([label] + list('%s="%s"' % i for i in extra)), repr(float(value))))
+
+        metric('run_timestamp_seconds', 'gauge', 'Start time of the last run.', [((), data['started'])])
+        metric('run_duration_seconds', 'gauge', 'Wall time of the last run.', [((), data['seconds'])])
+        metric('phase_duration_seconds', 'gauge', 'Time spent in each phase of the last run.', list(((('phase', k),), v['seconds']) for k, v in sorted(data['phases'].items())))
+        metric('run_items', 'gauge', 'Item and byte counts of the last run.', list(((('kind', k),), v) for k, v in sorted(data['counts'].items())))
+        metric('transfer_files', 'gauge', 'Files transferred in the last run.', [((), data['transfers']['files'])])
+        metric('transfer_bytes', 'gauge', 'Bytes of files transferred in the last run.', [((), data['transfers']['bytes'])])
+        metric('transfer_duration_seconds', 'gauge', 'Summed transfer time of files in the last run.', [((), data['transfers']['seconds'])])
+        metric('queue_depth_mean', 'gauge', 'Mean sampled depth of work queues.', list(((('queue', k),), v['mean']) for k, v in sorted(data['gauges'].items())))
+        metric('queue_depth_max', 'gauge', 'Maximum sampled depth of work queues.', list(((('queue', k),), v['max']) for k, v in sorted(data['gauges'].items())))
+        metric('worker_utilisation_ratio', 'gauge', 'Mean fraction of busy workers.', list(((('queue', k),), v['utilisation']) for k, v in sorted(data['gauges'].items()) if v['utilisation'] is not None))
+
+        return '\n'.join(lines) + '\n'
+
+    def close(self, skip=False):
+        self.closed.set()
+        if self.thread:
+            self.thread.join()
+        self.sample()
+
+        data = self.report()
+        for key, val in sorted(data['phases'].items(), key=lambda i: i[1]['offset']):
+            LOG.info('phase %s started at %.1fs and took %.3fs', key, val['offset'], val['seconds'])
+
+        if skip:
+            return data
+
+        for name, text in (('%s.json' % self.name, json.dumps(data, indent=2, sort_keys=True)), ('%s.prom' % self.name, self.prometheus(data))):
+            with open('%s.tmp' % name, 'w') as file:
+                file.write(text)
+            os.rename('%s.tmp' % name, name)
+
+        LOG.info('saved run report for %d transfers: %s.json', data['transfers']['files'], self.name)
+        return data
@@ -6,35 +6,142 @@ import textwrap
 
 from . import VERSION
 
+JOB_KEYS = set([
+    'hdfs_url', 'dest_dir', 'includes', 'checksums', 'temp_dir', 'sync_dir', 'arch_dir', 'part_dir', 'manifest', 'conf_dir',
+    'trust_index', 'generations', 'check_workers', 'cmd_timeout', 'peer_bind', 'peers', 'peer_wait', 'scan_age', 'full_scan', 'unpack_workers', 'queue_size',
+])
+
+
+def parse_jobs(parser, path, args):
+    import yaml
+
+    try:
+        with open(path) as data:
+            conf = yaml.safe_load(data) or []
+    except (IOError, yaml.YAMLError) as e:
+        parser.error('failed to load job file %s: %s' % (path, e))
+
+    if isinstance(conf, dict):
+        conf = conf.get('jobs', conf)
+    if isinstance(conf, dict):
+        conf = list(dict(v or {}, name=k) for k, v in sorted(conf.items()))
+
+    jobs, seen = [], {}
+    for i, item in enumerate(conf):
+        item = dict((k.replace('-', '_'), v) for k, v in item.items())
+        job = argparse.Namespace(**vars(args))
+        job.name = str(item.pop('name', i))
+        job.weight = float(item.pop('weight', 1))
+        if '/' in job.name or job.name in ('', '.', '..'):
+            parser.error('job %s: name must be usable as a directory name' % job.name)
+
+        for key, val in item.items():
+            if key not in JOB_KEYS:
+                parser.error('job %s: unsupported option: %s' % (job.name, key))
+            if key in ('includes', 'checksums', 'peers'):
+                val = [[val] if isinstance(val, basestring) else list(val)]
+            setattr(job, key, val)
+
+        if not job.hdfs_url or not job.dest_dir:
+            parser.error('job %s: hdfs_url and dest_dir are required' % job.name)
+
+        for key in (('name', job.name), ('index', os.path.join(os.path.abspath(job.dest_dir), os.path.basename(job.manifest))), ('peer', job.peer_bind)):
+            if key[1] and key in seen:
+                parser.error('job %s: %s %s already used by job %s' % (job.name, key[0], key[1], seen[key]))
+            seen[key] = job.name
+
+        jobs.append(job)
+
+    if not jobs:
+        parser.error('no jobs found in job file: %s' % path)
+
+    return jobs
+
 
 def parse_args(args=sys.argv[1:]):
     parser = argparse.ArgumentParser(description='hdfs directory sync', version=VERSION, formatter_class=argparse.RawDescriptionHelpFormatter)
-    parser.add_argument('-u', '--hdfs-url', required=True,
+    parser.add_argument('-u', '--hdfs-url',
                         help='full hdfs url to sync')
-    parser.add_argument('-d', '--dest-dir', required=True,
+    parser.add_argument('-d', '--dest-dir',
                         help='destination directory')
+    parser.add_argument('-J', '--jobs',
+                        help='yaml file of sources to sync in one process instead of --hdfs-url and --dest-dir')
     parser.add_argument('-i', '--includes', default=[], action='append', nargs='*',
                         help='explicit file globs instead of all')
+    parser.add_argument('-S', '--checksums', default=[], action='append', nargs='*',
+                        help='file globs to compare by hdfs checksum before fetching again')
     parser.add_argument('-t', '--temp-dir', default='/tmp',
                         help='where to put the temporary directory for downloads')
     parser.add_argument('-s', '--sync-dir', default='mirror',
                         help='relative directory to mirror sources into')
     parser.add_argument('-e', '--arch-dir', default='unpack',
                         help='relative directory to unpack archives into')
+    parser.add_argument('-P', '--part-dir', default='partial',
+                        help='relative directory under temp directory to keep resumable downloads in')
+    parser.add_argument('-T', '--trash-dir', default='trash',
+                        help='relative directory under temp directory to move deleted paths into before reaping')
+    parser.add_argument('-R', '--reap-rate', default=1000, type=int,
+                        help='limit background removal of trashed paths to this many entries per second (0 for unlimited)')
+    parser.add_argument('-G', '--generations', default=0, type=int,
+                        help='publish each sync as a hardlinked generation behind a "current" symlink, keeping this many (0 to disable)')
     parser.add_argument('-c', '--conf-dir',
                         help='directory of dataset configurations')
+    parser.add_argument('-x', '--check-workers', default=2, type=int,
+                        help='number of datasets to check and set up concurrently')
+    parser.add_argument('-X', '--cmd-timeout', default=0, type=float,
+                        help='kill dataset setup commands running longer than this many seconds (0 for no limit)')
     parser.add_argument('-p', '--run-port', default=2311, type=int,
                         help='lock loopback port number')
+    parser.add_argument('-D', '--daemon', default=False, action='store_true',
+                        help='keep running and serve status on the lock port between sync cycles')
+    parser.add_argument('-I', '--interval', default=3600, type=int,
+                        help='seconds between sync cycles in daemon mode')
+    parser.add_argument('-b', '--peer-bind',
+                        help='host:port to serve local files to peers on, enabling peer mode')
+    parser.add_argument('-g', '--peers', default=[], action='append', nargs='*',
+                        help='host:port of other peers mirroring the same hdfs directory')
+    parser.add_argument('-j', '--peer-wait', default=30, type=float,
+                        help='seconds to wait for the owning peer to fetch a file before fetching it from hdfs')
     parser.add_argument('-l', '--log-conf',
                         help='logger destination url')
     parser.add_argument('-m', '--manifest', default='.%s.idx' % os.path.splitext(os.path.basename(sys.argv[0]))[0],
                         help='manifest index file name')
+    parser.add_argument('-r', '--trust-index', default=False, action='store_true',
+                        help='trust the local index on startup and check local files for changes while listing')
+    parser.add_argument('-f', '--full-scan', default=False, action='store_true',
+                        help='ignore listing cache and rescan the whole remote tree')
+    parser.add_argument('-a', '--scan-age', default=0, type=int,
+                        help='reuse listings of unchanged remote directories until the last full remote scan is this many seconds old (0 to disable the listing cache)')
     parser.add_argument('-w', '--workers', type=int, default=multiprocessing.cpu_count(),
                         help='number of download threads')
+    parser.add_argument('-B', '--max-bandwidth', default=0, type=int,
+                        help='limit total download bandwidth to this many bytes per second (0 for unlimited)')
+    parser.add_argument('-H', '--max-host-conns', default=0, type=int,
+                        help='limit concurrent connections to each datanode (0 for unlimited)')
+    parser.add_argument('-k', '--pool-size', default=16, type=int,
+                        help='number of idle keep-alive connections to keep per host')
+    parser.add_argument('-K', '--pool-idle', default=30, type=float,
+                        help='seconds before an idle keep-alive connection is discarded')
+    parser.add_argument('-y', '--hedge-limit', default=2, type=int,
+                        help='number of concurrent hedged requests for straggling transfers (0 to disable)')
+    parser.add_argument('-Y', '--hedge-factor', default=4, type=float,
+                        help='hedge transfers running this many times slower than the median transfer rate')
+    parser.add_argument('-A', '--hedge-after', default=30, type=float,
+                        help='seconds a transfer must run before it can be hedged')
+    parser.add_argument('-U', '--unpack-workers', type=int, default=0,
+                        help='number of archive unpack processes (0 to unpack in download threads)')
+    parser.add_argument('-q', '--queue-size', type=int, default=1024,
+                        help='number of listed files to buffer ahead of the download queue')
     parser.add_argument('-n', '--dry-run', default=False, action='store_true',
                         help='show actions to be performed')
     parser.add_argument('-o', '--timeout', default=4, type=float,
                         help='request timeout in seconds')
+    parser.add_argument('-C', '--chunk-size', default=128*1024*1024, type=int,
+                        help='split files larger than this many bytes into ranged fetches (0 to disable)')
+    parser.add_argument('-W', '--chunk-workers', default=4, type=int,
+                        help='number of concurrent ranges per file')
+    parser.add_argument('-L', '--chunk-limit', default=2*multiprocessing.cpu_count(), type=int,
+                        help='number of concurrent ranges across all files')
     parser.epilog = textwrap.dedent('''
         supported logger formats:
           console://?level=LEVEL
@@ -42,6 +149,27 @@ def parse_args(args=sys.argv[1:]):
           syslog+tcp://HOST:PORT/?facility=FACILITY&level=LEVEL
           syslog+udp://HOST:PORT/?facility=FACILITY&level=LEVEL
           syslog+unix://PATH?facility=FACILITY&level=LEVEL
+
+        daemon mode controls:
+          curl http://127.0.0.1:RUN_PORT/status
+          curl -X POST http://127.0.0.1:RUN_PORT/sync[?full=1]
+          kill -HUP PID       start an incremental sync cycle now
+          kill -USR1 PID      start a full sync cycle now
+          kill -TERM PID      stop after the current sync cycle
+
+        job file format:
+          jobs:
+            NAME:
+              hdfs_url: URL
+              dest_dir: PATH
+              weight: SHARE   fair share of the download workers (default 1)
+              OPTION: VALUE   per-job override of a source or destination option
     ''')
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.jobs:
+        args.jobs = parse_jobs(parser, args.jobs, args)
+    elif not args.hdfs_url or not args.dest_dir:
+        parser.error('either --jobs or both --hdfs-url and --dest-dir are required')
+
+    return args
@@ -1,37 +1,61 @@
-import csv
 import json
 import logging
 import os
 import sys
-import xml.etree.cElementTree as et
-import yaml
 
 LOG = logging.getLogger()
 
 def parse(name):
     kind = os.path.splitext(name)[-1][1:].lower()
-    func = getattr(sys.modules[__name__], 'parse_%s' % kind)
+    func = getattr(sys.modules[__name__], 'parse_%s' % kind, None)
 
     if func:
         LOG.debug('parsing %s using %s', name, kind)
         return func(name)
     else:
-        raise RuntimeError('%s: unknown dataset format')
+        raise RuntimeError('%s: unknown dataset format' % name)
 
 def parse_json(name):
-    return json.load(open(name)).get('files', [])
+    try:
+        import ijson
+    except ImportError:
+        ijson = None
+
+    with open(name) as data:
+        if ijson:
+            for key, val in ijson.kvitems(data, 'files'):
+                yield key, int(val['size'])
+        else:
+            for key, val in json.load(data).get('files', {}).iteritems():
+                yield key, int(val['size'])
 
 def parse_yaml(name):
-    return yaml.load(open(name)).get('files', [])
+    import yaml
+
+    with open(name) as data:
+        for key, val in (yaml.load(data).get('files') or {}).iteritems():
+            yield key, int(val['size'])
 
 def parse_yml(name):
-    return yaml.load(open(name)).get('files', [])
+    return parse_yaml(name)
 
 def parse_xml(name):
-    return dict((i.attrib['name'], {'size': int(i.attrib['size'])}) for i in et.parse(name).findall('.//files/file'))
+    import xml.etree.cElementTree as et
+
+    depth = 0
+    for event, item in et.iterparse(name, events=('start', 'end')):
+        if item.tag == 'files':
+            depth += 1 if event == 'start' else -1
+        elif item.tag == 'file' and event == 'end' and depth:
+            yield item.attrib['name'], int(item.attrib['size'])
+            item.clear()
+
+def parse_csv(name, dialect='excel'):
+    import csv
 
-def parse_csv(name):
-    return dict((i['name'], {'size': int(i['size'])}) for i in csv.DictReader(open(name)))
+    with open(name) as data:
+        for item in csv.DictReader(data, dialect=dialect):
+            yield item['name'], int(item['size'])
 
 def parse_tsv(name):
-    return dict((i['name'], {'size': int(i['size'])}) for i in csv.DictReader(open(name), dialect='excel-tab'))
+    return parse_csv(name, 'excel-tab')
@@ -0,0 +1,188 @@
+import bisect
+import BaseHTTPServer
+import errno
+import hashlib
+import happy.client
+import httplib
+import json
+import logging
+import os
+import SocketServer
+import threading
+import time
+import urllib
+import urlparse
+
+LOG = logging.getLogger()
+
+
+class Ring(object):
+    def __init__(self, members, replicas=128):
+        self.members = sorted(set(members))
+        self.ring = sorted((self.hash('%s#%d' % (m, i)), m) for m in self.members for i in xrange(replicas))
+        self.keys = list(i[0] for i in self.ring)
+
+    def hash(self, key):
+        return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def owner(self, key):
+        return self.ring[bisect.bisect(self.keys, self.hash(key)) % len(self.ring)][1]
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    _block_size = 1024 * 1024
+    _prefix = '/webhdfs/v1'
+
+    def log_message(self, fmt, *args):
+        LOG.debug('peer request from %s: %s', self.client_address[0], fmt % args)
+
+    def reply(self, code, body='', kind='application/json'):
+        self.send_response(code)
+        self.send_header('Content-Type', kind)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        args = dict(urlparse.parse_qsl(url.query))
+        path = urllib.unquote(url.path)
+
+        if path == '/index':
+            return self.reply(200, json.dumps(self.server.index()))
+        if not path.startswith(self._prefix) or args.get('op') != 'OPEN':
+            return self.reply(400)
+
+        try:
+            size, date, full = path[len(self._prefix) + 1:].split('/', 2)
+            item = self.server.find('/%s' % full, int(size), int(date))
+        except ValueError:
+            return self.reply(400)
+
+        if not item:
+            return self.reply(404)
+
+        offset = int(args.get('offset', 0))
+        length = min(int(args.get('length', item.remote.size - offset)), item.remote.size - offset)
+        with open(item.fullname, 'rb') as data:
+            data.seek(offset)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(length))
+            self.end_headers()
+
+            while length > 0:
+                block = data.read(min(self._block_size, length))
+                if not block:
+                    break
+                self.wfile.write(block)
+                length -= len(block)
+
+        self.server.count(item)
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, addr, local):
+        BaseHTTPServer.HTTPServer.__init__(self, addr, Handler)
+        self.local = local
+        self.lock = threading.Lock()
+        self.stats = {'files': 0, 'bytes': 0}
+
+    def index(self):
+        return dict((k, [v.remote.size, int(v.filetime)]) for k, v in (self.local() or {}).items())
+
+    def find(self, path, size, date):
+        item = (self.local() or {}).get(path)
+        if not item or item.remote.size != size or int(item.filetime) != date:
+            return None
+
+        try:
+            info = os.stat(item.fullname)
+        except OSError:
+            return None
+
+        if info.st_size == size and int(info.st_mtime) == date:
+            return item
+
+    def count(self, item):
+        with self.lock:
+            self.stats['files'] += 1
+            self.stats['bytes'] += item.remote.size
+
+
+class Peers(object):
+    _retry = 60
+
+    def __init__(self, name, members, local, user, wait, size=0, workers=1, limit=1, patience=30):
+        self.name = name
+        self.ring = Ring(list(members) + [name])
+        self.clients = dict((i, happy.client.HDFSClient('http://%s' % i, user, wait, size, workers, limit)) for i in self.ring.members if i != name)
+        self.patience = patience
+        self.lock = threading.Lock()
+        self.down = {}
+        self.stats = {'files': 0, 'bytes': 0, 'misses': 0}
+
+        host, port = name.rsplit(':', 1)
+        self.server = Server((host, int(port)), local)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='peer')
+        self.thread.daemon = True
+        self.thread.start()
+
+        LOG.info('serving local files to %d peers on %s', len(self.clients), name)
+
+    def owner(self, item):
+        return self.ring.owner(item.remote.full)
+
+    def owns(self, item):
+        return self.owner(item) == self.name
+
+    def fetch(self, item, part, sink=None):
+        owner = self.owner(item)
+        if owner == self.name:
+            return False
+
+        path = '/%d/%d%s' % (item.remote.size, int(item.filetime), item.remote.full)
+        stop = time.time() + self.patience
+        while True:
+            with self.lock:
+                if self.down.get(owner, 0) > time.time():
+                    break
+
+            try:
+                self.clients[owner].fetch(path, part, sink)
+                with self.lock:
+                    self.stats['files'] += 1
+                    self.stats['bytes'] += item.remote.size
+                LOG.info('fetched hdfs file %s from peer %s', item.remote.full, owner)
+                return True
+            except (RuntimeError, IOError, httplib.HTTPException) as e:
+                if (isinstance(e, RuntimeError) or getattr(e, 'errno', None) == errno.ECONNREFUSED) and time.time() < stop:
+                    time.sleep(min(1, stop - time.time()))
+                    continue
+
+                if isinstance(e, RuntimeError):
+                    LOG.debug('peer %s does not have %s yet, giving up: %s', owner, item.remote.full, e)
+                else:
+                    LOG.warning('peer %s failed, skipping it for %ds: %s', owner, self._retry, e)
+                    with self.lock:
+                        self.down[owner] = time.time() + self._retry
+                break
+
+        with self.lock:
+            self.stats['misses'] += 1
+        return False
+
+    def report(self):
+        LOG.info('fetched %d files (%d bytes) from peers with %d misses, served %d files (%d bytes) to peers',
+                 self.stats['files'], self.stats['bytes'], self.stats['misses'], self.server.stats['files'], self.server.stats['bytes'])
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for item in self.clients.values():
+            item.pool.close()
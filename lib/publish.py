@@ -0,0 +1,49 @@
+import happy.syncer
+import happy.trash
+import logging
+import os
+import tempfile
+import time
+
+LOG = logging.getLogger()
+
+
+def published(root, name='current'):
+    return os.path.exists('%s/%s' % (root, name))
+
+
+def publish(root, paths, keep=1, skip=False, name='current', store='generations'):
+    base = '%s/%s' % (root, store)
+    link = '%s/%s' % (root, name)
+
+    if skip:
+        LOG.info('publishing new generation of %s as %s', ', '.join(paths), link)
+        return
+
+    if not os.path.exists(base):
+        os.makedirs(base)
+        LOG.info('created generation path: %s', base)
+
+    data = tempfile.mkdtemp(prefix='%s.' % time.strftime('%Y%m%d%H%M%S'), dir=base)
+    os.chmod(data, 0755)
+
+    try:
+        for path in paths:
+            target = '%s/%s' % (data, os.path.basename(path))
+            os.mkdir(target)
+            happy.syncer.link_tree(path, target)
+    except Exception:
+        happy.trash.discard(data)
+        raise
+
+    temp = '%s.tmp' % link
+    if os.path.lexists(temp):
+        os.unlink(temp)
+    os.symlink(os.path.relpath(data, root), temp)
+    os.rename(temp, link)
+    LOG.info('published generation %s as %s', data, link)
+
+    older = sorted(i for i in os.listdir(base) if i != os.path.basename(data))
+    for item in older[:max(0, len(older) - keep + 1)]:
+        LOG.info('retiring old generation: %s/%s', base, item)
+        happy.trash.discard('%s/%s' % (base, item))
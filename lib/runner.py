@@ -1,17 +1,24 @@
 import datetime
 import errno
 import getpass
+import happy.archive
+import happy.client
+import happy.dataset
+import happy.index
+import happy.matcher
+import happy.metrics
+import happy.publish
+import happy.scheduler
 import happy.state
+import happy.trash
 import itertools
 import logging
-import multiprocessing.pool
 import os
-import pickle
 import socket
 import sys
+import threading
 import time
 import urlparse
-import webhdfs
 
 
 LOG = logging.getLogger()
@@ -21,80 +28,394 @@ def setup_socket(port, sock=socket.socket()):
         sock.bind(('127.0.0.1', port))
         sock.listen(1)
         LOG.debug('bound local listening socket for mutual exclusion on port: %d', port)
+        return sock
     except socket.error as e:
         if e.errno == errno.EADDRINUSE:
-            LOG.err('another %s process is already running', sys.argv[0])
+            LOG.error('another %s process is already running', sys.argv[0])
         else:
             happy.log_error(e)
         sys.exit(1)
 
 
-def setup_runner(args):
-    setup_socket(args.run_port)
+def setup_client(args, url):
+    return happy.client.HDFSClient(url, getpass.getuser(), args.timeout, args.chunk_size, args.chunk_workers, args.chunk_limit, args.max_host_conns,
+                                   pool=happy.client.ConnectionPool(args.pool_size, args.pool_idle, args.timeout),
+                                   hedge=happy.client.Hedger(args.hedge_limit, args.hedge_factor, args.hedge_after) if args.hedge_limit > 0 else None)
 
-    dest_dir = os.path.abspath(args.dest_dir)
-    temp_dir = os.path.abspath(args.temp_dir)
-    sync_dir = os.path.normpath('%s/%s' % (dest_dir, args.sync_dir))
-    arch_dir = os.path.normpath('%s/%s' % (dest_dir, args.arch_dir))
 
-    if os.stat(dest_dir).st_dev != os.stat(temp_dir).st_dev:
-        LOG.err('destination and temp directores are cross-device')
-        sys.exit(1)
+class Runner(object):
+    def __init__(self, args, base=None):
+        self.args = args
+        self.name = getattr(args, 'name', None)
+        self.shared = base is not None
+        self.dest_dir = os.path.abspath(args.dest_dir)
+        self.temp_dir = os.path.abspath(args.temp_dir)
+        self.part_dir = os.path.normpath('%s/%s' % (self.temp_dir, args.part_dir))
+        if self.name is not None:
+            self.part_dir = '%s/%s' % (self.part_dir, self.name)
+        self.trash_dir = os.path.normpath('%s/%s' % (self.temp_dir, args.trash_dir))
+        self.sync_dir = os.path.normpath('%s/%s' % (self.dest_dir, args.sync_dir))
+        self.arch_dir = os.path.normpath('%s/%s' % (self.dest_dir, args.arch_dir))
 
-    hdfs_url = urlparse.urlparse(args.hdfs_url)
-    hdfs_dir = hdfs_url.path
-    hdfs_api = webhdfs.WebHDFSClient(hdfs_url._replace(path='').geturl(), user=getpass.getuser(), wait=args.timeout)
-    includes = set(itertools.chain.from_iterable(args.includes)) or ['*']
-    start_ts = datetime.datetime.now()
+        if os.stat(self.dest_dir).st_dev != os.stat(self.temp_dir).st_dev:
+            LOG.error('destination and temp directores are cross-device')
+            sys.exit(1)
 
-    try:
-        if not os.path.exists(sync_dir):
-            if not args.dry_run:
-                os.makedirs(sync_dir)
-                LOG.info('created mirror path: %s', sync_dir)
-            else:
-                LOG.info('creating mirror path: %s', sync_dir)
-        if not os.path.exists(arch_dir):
-            if not args.dry_run:
-                os.makedirs(arch_dir)
-                LOG.info('created unpack path: %s', arch_dir)
-            else:
-                LOG.info('creating unpack path: %s', arch_dir)
+        hdfs_url = urlparse.urlparse(args.hdfs_url)
+        self.hdfs_dir = hdfs_url.path
+        self.hdfs_api = base.clone(hdfs_url._replace(path='').geturl()) if base else setup_client(args, hdfs_url._replace(path='').geturl())
+        self.includes = set(itertools.chain.from_iterable(args.includes)) or ['*']
+        self.checksum = happy.matcher.Matcher(itertools.chain.from_iterable(args.checksums))
+
+        self.trash = None
+        self.unzip = None
+        self.peers = None
+        self.index = None
+        self.local = None
+        self.known = None
+        self.cache = None
+        self.cycles = 0
+        self.current = None
+        self.last = None
+
+    def setup_unpack(self):
+        if self.args.unpack_workers > 0 and not self.args.dry_run and not self.unzip:
+            self.unzip = happy.archive.UnpackPool(self.args.unpack_workers, self.temp_dir)
+
+    def setup(self):
+        self.setup_unpack()
+
+        for path, text in ((self.sync_dir, 'mirror'), (self.arch_dir, 'unpack'), (self.part_dir, 'partial')):
+            if not os.path.exists(path):
+                if not self.args.dry_run:
+                    os.makedirs(path)
+                    LOG.info('created %s path: %s', text, path)
+                else:
+                    LOG.info('creating %s path: %s', text, path)
+
+        if not self.args.dry_run and not self.shared:
+            self.trash = happy.trash.setup_trash(self.trash_dir, self.args.reap_rate)
+
+        self.index = happy.index.Index(os.path.normpath('%s/%s' % (self.dest_dir, os.path.basename(self.args.manifest))), self.args.dry_run)
+        self.cache = happy.state.setup_cache('%s.ls' % self.index.name, self.args.scan_age, self.args.full_scan)
+
+        if self.args.peer_bind:
+            from happy.peer import Peers
+
+            args = self.args
+            self.peers = Peers(args.peer_bind, itertools.chain.from_iterable(args.peers), lambda: self.local, getpass.getuser(), args.timeout, args.chunk_size, args.chunk_workers, args.chunk_limit, args.peer_wait)
+
+    def load(self, trust=False):
+        self.local = happy.state.setup_local(self.index, self.hdfs_dir, self.sync_dir, self.arch_dir, self.args.workers, trust)
+        self.known = happy.index.ContentIndex(self.local.values())
 
-        index = os.path.normpath('%s/%s' % (dest_dir, os.path.basename(args.manifest)))
-        local = happy.state.setup_local(index, sync_dir, arch_dir)
-        avail = happy.state.setup_avail(hdfs_api, hdfs_dir, includes, sync_dir, arch_dir)
-        check = happy.state.setup_check(args.conf_dir)
-        procs = multiprocessing.pool.ThreadPool(processes=args.workers)
+    def status(self):
+        data = {'cycles': self.cycles, 'current': None, 'last': self.last}
+
+        current = self.current
+        if current:
+            procs, meter = current['procs'], current.get('meter')
+            data['current'] = {
+                'started': current['started'],
+                'full': current['full'],
+                'seconds': time.time() - current['started'],
+                'transfers': dict(procs.stats) if procs else None,
+                'received': meter.bytes if meter else 0,
+            }
+
+        return data
+
+    def run(self, full=False, procs=None):
+        self.cycles += 1
+        self.current = {'started': time.time(), 'full': full or self.local is None, 'procs': None}
+
+        try:
+            return self.cycle(full, procs)
+        finally:
+            self.current = None
+
+    def cycle(self, full=False, procs=None):
+        args = self.args
+        hdfs_api, hdfs_dir = self.hdfs_api, self.hdfs_dir
+        start_ts = datetime.datetime.now()
+        stats = happy.metrics.Metrics(self.index.name)
+        audit = None
+
+        loaded = self.local is None or full
+        if loaded:
+            with stats.phase('load'):
+                self.load(args.trust_index)
+        if full or not args.scan_age or time.time() - self.cache['time'] > args.scan_age:
+            LOG.info('performing full remote scan and local cleanup')
+            self.cache = {'time': time.time(), 'dirs': {}}
+            self.current['full'] = True
+        if self.current['full'] and (args.trust_index or not loaded):
+            audit = self.local.items()
+
+        index, local, known, cache = self.index, self.local, self.known, self.cache
+        check = happy.dataset.Datasets(happy.state.setup_check(args.conf_dir), local, index, args.check_workers, args.cmd_timeout, args.dry_run, args.workers)
+
+        def changed(count=1):
+            if count and args.generations and not index.get('unpublished'):
+                index.set('unpublished', '1')
+
+        def store(key, item, done):
+            if done:
+                changed()
+                local[key] = item
+                index.put(item)
+                known.add(item)
+            check.done(key, done)
+
+        unzip = self.unzip
+        owner = procs is None
+        if owner:
+            procs = happy.scheduler.Scheduler(args.workers, args.max_bandwidth)
+        meter = hdfs_api.meter = happy.scheduler.Meter(parent=procs.meter)
+        self.current['procs'] = procs
+        self.current['meter'] = meter
+        lock = threading.Lock()
+        avail = set()
         xfers = {}
 
-        for key, val in avail.items():
-            if (key not in local or not val.equal(local[key])):
-                xfers[key] = procs.apply_async(val.fetch, (hdfs_api, temp_dir, args.dry_run))
+        def queue(key, val, last):
+            check.add(key)
+            xfers[key] = (val, procs.submit(val.remote.size, val.fetch, (hdfs_api, self.temp_dir, args.dry_run, self.part_dir, unzip, last, self.checksum.match(key[len(hdfs_dir) + 1:]), known, self.peers), callback=lambda done: store(key, val, done), rank=int(bool(self.peers and not self.peers.owns(val))), group=self.name))
+
+        def verify(items):
+            start = time.time()
+            try:
+                for key in happy.state.audit_local(items, args.workers):
+                    LOG.warning('file changed or disappeared: %s', key)
+                    with lock:
+                        if key in xfers:
+                            continue
+                        val = local.pop(key, None)
+                        index.delete(key)
+                        stats.count('audited')
+                        if val and key in avail:
+                            queue(key, val, None)
+            except Exception as e:
+                happy.log_error(e, 'local file audit failed')
+            finally:
+                stats.spent('audit', time.time() - start, start)
+
+        if audit:
+            audit = threading.Thread(target=verify, args=(audit,), name='audit')
+            audit.daemon = True
+            audit.start()
 
-        procs.close()
-        procs.join()
+        stats.probe('fetch_queue', procs.pending)
+        stats.probe('fetch_active', procs.active, procs.workers)
+        if unzip:
+            stats.probe('unpack_queue', unzip.pending, unzip.depth)
 
-        for key, val in xfers.items():
-            if val.get():
-                local[key] = avail[key]
+        with stats.phase('fetch'):
+            try:
+                with stats.phase('list'):
+                    for key, val in happy.state.queue_avail(args.queue_size, hdfs_api, hdfs_dir, self.includes, self.sync_dir, self.arch_dir, cache):
+                        diff = time.time()
+                        with lock:
+                            avail.add(key)
+                            if (key not in local or not val.equal(local[key])):
+                                queue(key, val, local.get(key))
+                        stats.spent('diff', time.time() - diff, diff)
+                if audit:
+                    audit.join()
+                check.finish()
+            finally:
+                if owner:
+                    procs.close()
+                    procs.join()
+                else:
+                    for val, done in xfers.values():
+                        done.event.wait()
+
+        if unzip:
+            with stats.phase('unpack'):
+                unzip.wait()
+
+        known.report()
+        if hdfs_api.hedge and not self.shared:
+            hdfs_api.hedge.report()
+        if self.peers:
+            self.peers.report()
+
+        for key, (val, done) in xfers.items():
+            if done.get():
+                stats.file(key, val.remote.size, done.spent)
             else:
-                LOG.err('failed to fetch %s', key)
+                LOG.error('failed to fetch %s', key)
+                stats.count('failed')
 
-        for key, val in local.items():
-            if key not in avail and val.purge(args.dry_run):
-                del(local[key])
+        stats.count('listed', len(avail))
+        stats.count('queued', len(xfers))
+        stats.count('reused', known.stats['files'])
+        stats.count('received_bytes', meter.bytes)
 
-        for key, val in local.items():
-            if val.remote.full in check:
-                val.check(check[val.remote.full], os.stat(index).st_mtime if os.path.exists(index) else time.mktime(datetime.datetime.min.timetuple()), args.dry_run)
+        with stats.phase('purge'):
+            for key, val in local.items():
+                if key not in avail and val.purge(args.dry_run):
+                    del(local[key])
+                    index.delete(key)
+                    stats.count('purged')
+                    changed()
 
-        if not args.dry_run:
-            pickle.dump(local, open(index, 'w'))
-            LOG.info('saved %d items to index: %s', len(local), index)
+        with stats.phase('check'):
+            check.close()
 
-        happy.state.clean_local(index, local, sync_dir, arch_dir, args.dry_run)
+        with stats.phase('save'):
+            if not args.dry_run:
+                index.set('saved', repr(time.time()))
+                index.set('mirror', self.sync_dir)
+                index.set('unpack', self.arch_dir)
+                LOG.info('saved %d items to index: %s', len(local), index.name)
 
-        LOG.info('execution completed in %ds', (datetime.datetime.now() - start_ts).total_seconds())
+                if args.scan_age:
+                    happy.state.save_cache('%s.ls' % index.name, cache)
+
+        with stats.phase('cleanup'):
+            if self.current['full']:
+                changed(happy.state.clean_local(index, local, self.sync_dir, self.arch_dir, args.dry_run, args.workers))
+            happy.state.clean_partial(self.part_dir, avail, args.dry_run)
+
+        if args.generations and not index.get('unpublished') and happy.publish.published(self.dest_dir):
+            LOG.info('nothing changed since the last published generation, skipping publish')
+        elif args.generations:
+            with stats.phase('publish'):
+                happy.publish.publish(self.dest_dir, [self.sync_dir, self.arch_dir], args.generations, args.dry_run)
+            index.set('unpublished', '')
+
+        data = stats.close(args.dry_run)
+        self.last = {
+            'started': data['started'],
+            'seconds': data['seconds'],
+            'full': self.current['full'],
+            'counts': data['counts'],
+            'transfers': data['transfers'],
+        }
+
+        LOG.info('%s completed in %ds', 'job %s' % self.name if self.name else 'execution', (datetime.datetime.now() - start_ts).total_seconds())
+        return data
+
+    def close(self):
+        if self.index:
+            self.index.close()
+        if self.trash:
+            self.trash.close()
+        if self.unzip:
+            self.unzip.close()
+        if self.peers:
+            self.peers.close()
+        if not self.shared:
+            if self.hdfs_api.hedge:
+                self.hdfs_api.hedge.close()
+            self.hdfs_api.pool.close()
+
+
+class Jobs(object):
+    def __init__(self, args):
+        self.args = args
+        self.hdfs_api = setup_client(args, urlparse.urlparse(args.jobs[0].hdfs_url)._replace(path='').geturl())
+        self.runners = list(Runner(i, self.hdfs_api) for i in args.jobs)
+
+        self.trash = None
+        self.cycles = 0
+        self.current = None
+        self.last = None
+
+    def setup(self):
+        for item in self.runners:
+            item.setup_unpack()
+
+        if not self.args.dry_run:
+            self.trash = happy.trash.setup_trash(os.path.normpath('%s/%s' % (os.path.abspath(self.args.temp_dir), self.args.trash_dir)), self.args.reap_rate)
+
+        for item in self.runners:
+            item.setup()
+
+        LOG.info('loaded %d sync jobs: %s', len(self.runners), ', '.join(i.name for i in self.runners))
+
+    def status(self):
+        data = {'cycles': self.cycles, 'current': None, 'last': self.last, 'jobs': dict((i.name, i.status()) for i in self.runners)}
+
+        current = self.current
+        if current:
+            data['current'] = {
+                'started': current['started'],
+                'full': current['full'],
+                'seconds': time.time() - current['started'],
+                'transfers': dict(current['procs'].stats),
+                'received': current['procs'].meter.bytes,
+            }
+
+        return data
+
+    def run(self, full=False):
+        args = self.args
+        procs = happy.scheduler.Scheduler(args.workers, args.max_bandwidth)
+        failed = []
+
+        self.cycles += 1
+        self.current = {'started': time.time(), 'full': full, 'procs': procs}
+
+        def run(runner):
+            try:
+                runner.run(full, procs)
+            except Exception as e:
+                happy.log_error(e, 'job %s failed' % runner.name)
+                failed.append(runner.name)
+
+        try:
+            threads = []
+            for item in self.runners:
+                procs.share(item.name, item.args.weight)
+                threads.append(threading.Thread(target=run, args=(item,), name='job-%s' % item.name))
+                threads[-1].start()
+
+            for item in threads:
+                item.join()
+        finally:
+            procs.close()
+            procs.join()
+            self.current = None
+
+        if self.hdfs_api.hedge:
+            self.hdfs_api.hedge.report()
+
+        self.last = {
+            'started': procs.start,
+            'seconds': time.time() - procs.start,
+            'full': full,
+            'received': procs.meter.bytes,
+            'failed': sorted(failed),
+        }
+
+    def close(self):
+        for item in self.runners:
+            item.close()
+        if self.trash:
+            self.trash.close()
+        if self.hdfs_api.hedge:
+            self.hdfs_api.hedge.close()
+        self.hdfs_api.pool.close()
+
+
+def setup_runner(args):
+    sock = setup_socket(args.run_port)
+
+    try:
+        runner = Jobs(args) if args.jobs else Runner(args)
+        runner.setup()
+
+        if args.daemon:
+            from happy.daemon import Daemon
+
+            Daemon(runner, sock, args.interval).run()
+        else:
+            try:
+                runner.run()
+            finally:
+                runner.close()
     except Exception as e:
         happy.log_error(e)
@@ -0,0 +1,176 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+LOG = logging.getLogger()
+
+
+class Meter(object):
+    def __init__(self, rate=0, parent=None):
+        self.rate = float(rate)
+        self.parent = parent
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.tokens = self.rate
+        self.stamp = time.time()
+
+    def consume(self, size):
+        if self.parent:
+            self.parent.consume(size)
+
+        with self.lock:
+            self.bytes += size
+            if not self.rate:
+                return
+
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate) - size
+            self.stamp = now
+            wait = -self.tokens / self.rate
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Task(object):
+    def __init__(self, size, func, args, callback=None):
+        self.size = size
+        self.func = func
+        self.args = args
+        self.callback = callback
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+        self.spent = 0.0
+
+    def run(self):
+        start = time.time()
+        try:
+            self.value = self.func(*self.args)
+            if self.callback:
+                self.callback(self.value)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.spent = time.time() - start
+            self.event.set()
+
+    def get(self, timeout=None):
+        self.event.wait(timeout)
+        if self.error:
+            raise self.error
+        return self.value
+
+
+class Scheduler(object):
+    def __init__(self, workers, rate=0, interval=60):
+        self.cond = threading.Condition()
+        self.queues = {}
+        self.shares = {}
+        self.served = {}
+        self.closing = False
+        self.order = itertools.count()
+        self.meter = Meter(rate)
+        self.lock = threading.Lock()
+        self.stats = {'queued': 0, 'bytes': 0, 'done': 0, 'active': 0}
+        self.start = time.time()
+        self.interval = interval
+        self.closed = threading.Event()
+        self.watcher = None
+        self.workers = max(1, workers)
+        self.threads = list(threading.Thread(target=self.run, name='worker-%d' % i) for i in xrange(self.workers))
+
+        for item in self.threads:
+            item.daemon = True
+            item.start()
+
+        if interval:
+            self.watcher = threading.Thread(target=self.watch, name='scheduler')
+            self.watcher.daemon = True
+            self.watcher.start()
+
+    def share(self, group, weight=1):
+        with self.cond:
+            self.shares[group] = max(float(weight), 0.001)
+
+    def submit(self, size, func, args=(), callback=None, rank=0, group=None):
+        task = Task(size, func, args, callback)
+        with self.lock:
+            self.stats['queued'] += 1
+            self.stats['bytes'] += size
+
+        with self.cond:
+            if not self.queues.get(group):
+                busy = list(self.served[i] for i, q in self.queues.items() if q)
+                self.served[group] = max(self.served.get(group, 0), min(busy) if busy else 0)
+            heapq.heappush(self.queues.setdefault(group, []), (rank, -size, next(self.order), task))
+            self.cond.notify()
+        return task
+
+    def next(self):
+        with self.cond:
+            while True:
+                ready = list((self.served[i], i) for i, q in self.queues.items() if q)
+                if ready:
+                    break
+                if self.closing:
+                    return None
+                self.cond.wait()
+
+            group = min(ready, key=lambda i: i[0])[1]
+            rank, size, order, task = heapq.heappop(self.queues[group])
+            self.served[group] += max(-size, 1) / self.shares.get(group, 1.0)
+            return task
+
+    def run(self):
+        while True:
+            task = self.next()
+            if task is None:
+                break
+
+            with self.lock:
+                self.stats['active'] += 1
+            try:
+                task.run()
+            finally:
+                with self.lock:
+                    self.stats['active'] -= 1
+                    self.stats['done'] += 1
+
+    def pending(self):
+        with self.cond:
+            return sum(len(i) for i in self.queues.values())
+
+    def active(self):
+        return self.stats['active']
+
+    def eta(self):
+        spent = time.time() - self.start
+        speed = self.meter.bytes / spent if spent > 0 else 0
+        return speed, (self.stats['bytes'] - self.meter.bytes) / speed if speed else None
+
+    def report(self):
+        speed, left = self.eta()
+        LOG.info('completed %d of %d transfers (%d active) at %.1f KiB/s, estimated %s remaining',
+                 self.stats['done'], self.stats['queued'], self.stats['active'], speed / 1024,
+                 '%ds' % left if left is not None else 'unknown time')
+
+    def watch(self):
+        while not self.closed.wait(self.interval):
+            self.report()
+
+    def close(self):
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+
+    def join(self):
+        for item in self.threads:
+            item.join()
+
+        self.closed.set()
+        if self.watcher:
+            self.watcher.join()
+        self.report()
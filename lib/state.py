@@ -1,21 +1,43 @@
 import errno
 import fnmatch
+import happy.client
+import happy.matcher
 import happy.syncer
+import happy.trash
+import json
 import logging
+import multiprocessing.pool
 import os
 import pickle
-import shutil
-import yaml
+import Queue
+import stat
+import threading
+import time
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 LOG = logging.getLogger()
 
+SETTLE_TIME = 3600
+
 
-def setup_local(index, mirror, unpack):
+def setup_local(index, source, mirror, unpack, workers=1, trust=False):
     local = {}
 
-    LOG.debug('reading local index: %s', index)
+    LOG.debug('reading local index: %s', index.name)
     try:
-        for key, val in pickle.load(open(index)).items():
+        if index.get('mirror', mirror) != mirror:
+            LOG.warning('detected mirror directory move from %s to %s', index.get('mirror'), mirror)
+        if index.get('unpack', unpack) != unpack:
+            LOG.warning('detected unpack directory move from %s to %s', index.get('unpack'), unpack)
+
+        for key, val in index.load(source, mirror, unpack).items():
             if val.mirror != mirror:
                 LOG.warning('detected mirror directory move from %s to %s', val.mirror, mirror)
                 val.mirror = mirror
@@ -23,10 +45,13 @@ def setup_local(index, mirror, unpack):
                 LOG.warning('detected unpack directory move from %s to %s', val.unpack, unpack)
                 val.unpack = unpack
 
-            if not val.modified:
-                local[key] = val
-            else:
+            local[key] = val
+
+        if not trust:
+            for key in audit_local(local.items(), workers):
                 LOG.warning('file changed or disappeared: %s', key)
+                del(local[key])
+                index.delete(key)
     except Exception as e:
         if getattr(e, 'errno', None) == errno.ENOENT:
             LOG.warning('no local index available, performing full fetch')
@@ -37,11 +62,101 @@ def setup_local(index, mirror, unpack):
     return local
 
 
-def setup_avail(client, source, filter, mirror, unpack):
-    avail = {}
+def audit_local(items, workers=1):
+    procs = multiprocessing.pool.ThreadPool(processes=max(1, workers))
+    seen = found = 0
+
+    try:
+        for key, modified in procs.imap_unordered(lambda i: (i[0], i[1].modified), items, 64):
+            seen += 1
+            if modified:
+                found += 1
+                yield key
+    finally:
+        procs.close()
+        procs.join()
+
+    LOG.info('audited %d local files, %d changed or disappeared', seen, found)
+
+
+def setup_cache(name, age, fresh=False):
+    cache = {'time': time.time(), 'dirs': {}}
+
+    if not age:
+        LOG.debug('listing cache disabled, performing full remote scans')
+        return cache
+
+    LOG.debug('reading listing cache: %s', name)
+    try:
+        data = happy.client.unpickle(open(name, 'rb'))
+        if any(not isinstance(j, happy.client.RemoteFile) for i in data['dirs'].values() for j in i[1]):
+            LOG.info('discarding listing cache written by an older version, performing full remote scan')
+        elif fresh:
+            LOG.info('ignoring listing cache, performing full remote scan')
+        elif time.time() - data['time'] > age:
+            LOG.info('last full remote scan is older than %ds, performing full remote scan', age)
+        else:
+            cache = data
+    except Exception as e:
+        if getattr(e, 'errno', None) == errno.ENOENT:
+            LOG.warning('no listing cache available, performing full remote scan')
+        else:
+            happy.log_error(e)
+
+    LOG.info('loaded listing cache containing %d directories', len(cache['dirs']))
+    return cache
+
+
+def save_cache(name, cache):
+    with open('%s.tmp' % name, 'w') as data:
+        pickle.dump(cache, data, pickle.HIGHEST_PROTOCOL)
+    os.rename('%s.tmp' % name, name)
+
+    LOG.info('saved %d directories to listing cache: %s', len(cache['dirs']), name)
+
+
+def list_remote(client, source, cache, prune, seen):
+    dirs = {}
+    settle = time.time() - SETTLE_TIME
+    todo = [(source, client.stat(source).mtime)]
+
+    while todo:
+        path, date = todo.pop()
+        if path in cache['dirs'] and cache['dirs'][path][0] == date:
+            LOG.debug('reusing cached listing of unchanged directory: %s', path)
+            items = cache['dirs'][path][1]
+            seen['cached'] += 1
+            live = False
+        else:
+            LOG.debug('listing changed directory: %s', path)
+            items = client.ls(path)
+            seen['listed'] += 1
+            live = True
+
+        if any(not i.is_dir() and i.mtime > settle for i in items):
+            LOG.debug('not caching listing of recently modified directory: %s', path)
+        else:
+            dirs[path] = (date, items)
+
+        for item in items:
+            if item.is_dir():
+                if prune(item.full[len(source) + 1:]):
+                    LOG.debug('pruning excluded directory: %s', item.full)
+                    seen['pruned'] += 1
+                    continue
+                todo.append((item.full, item.mtime if live else client.stat(item.full).mtime))
+            yield item
+
+    cache['dirs'] = dirs
+    LOG.info('listed %d changed and reused %d unchanged remote directories', seen['listed'], seen['cached'])
+
+
+def setup_avail(client, source, filter, mirror, unpack, cache=None):
+    match = happy.matcher.Matcher(filter)
+    seen = {'listed': 0, 'cached': 0, 'pruned': 0, 'skipped': 0, 'queued': 0}
 
     LOG.debug('fetching file list')
-    for item in client.ls(source, recurse=True):
+    for item in list_remote(client, source, cache or {'dirs': {}}, match.prune, seen):
         if item.name.endswith('_COPYING_'):
             LOG.debug('skipping transferring hdfs object: %s', item.full)
             continue
@@ -50,21 +165,65 @@ def setup_avail(client, source, filter, mirror, unpack):
             continue
 
         try:
-            for find in filter:
-                if fnmatch.fnmatch(item.full[len(source) + 1:], find):
-                    LOG.info('queueing hdfs object: %s', item.full)
-                    avail[item.full] = happy.syncer.SyncFile(item, source, mirror, unpack)
-                    break
+            if match.match(item.full[len(source) + 1:]):
+                LOG.info('queueing hdfs object: %s', item.full)
+                seen['queued'] += 1
+                yield item.full, happy.syncer.SyncFile(item, source, mirror, unpack)
             else:
                 LOG.debug('skipping excluded hdfs object: %s', item.full)
+                seen['skipped'] += 1
         except Exception as e:
             happy.log_error(e)
 
-    LOG.info('read remote list containing %d items', len(avail))
-    return avail
+    LOG.info('read remote list containing %d items', seen['queued'])
+    LOG.info('pruned %d excluded directories and skipped %d excluded files', seen['pruned'], seen['skipped'])
+
+
+def queue_avail(size, *args):
+    queue = Queue.Queue(maxsize=size)
+    stop = threading.Event()
+    fail = []
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+
+    def produce():
+        try:
+            for item in setup_avail(*args):
+                if not put(item):
+                    LOG.debug('listing consumer stopped, abandoning remote listing')
+                    break
+        except Exception as e:
+            fail.append(e)
+        finally:
+            put(None)
+
+    thread = threading.Thread(target=produce, name='lister')
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            yield item
+    finally:
+        stop.set()
+
+    thread.join()
+    if fail:
+        raise fail[0]
 
 
 def setup_check(config):
+    import yaml
+
     check = {}
 
     LOG.debug('looking for dataset configs in %s', config)
@@ -91,37 +250,116 @@ def setup_check(config):
     return check
 
 
-def clean_local(index, local, mirror, unpack, skip=False):
-    mirrored = list(i.fullname for i in local.values())
-    unpacked = list(i.zip_path for i in local.values() if i.zip_path)
+def list_local(path, stats=False):
+    paths, files = [], []
 
-    for path, paths, files in os.walk(mirror, topdown=False):
-        for name in files:
-            full = '%s/%s' % (path, name)
-            if full not in mirrored:
-                LOG.info('removing orphaned local file: %s', full)
-                if not skip:
-                    os.unlink(full)
-
-        if not skip:
-            for name in paths:
-                full = '%s/%s' % (path, name)
-                try:
-                    os.rmdir(full)
-                    LOG.info('removed orphaned local empty directory: %s', full)
-                except OSError as e:
-                    if e.errno != errno.ENOTEMPTY:
-                        raise e
-
-    for path, paths, files in os.walk(unpack, topdown=False):
-        for name in paths:
-            full = '%s/%s' % (path, name)
-            for arch in unpacked:
-                same = os.path.commonprefix([full, arch])
-                if same == arch or same == full:
-                    paths.remove(name)
-                    break
+    if scandir:
+        for item in scandir(path):
+            if item.is_dir(follow_symlinks=False):
+                paths.append(item.name)
+            elif not stats:
+                files.append(item.name)
+            elif item.is_file():
+                files.append((item.name, item.stat()))
+    else:
+        for name in os.listdir(path):
+            info = os.lstat('%s/%s' % (path, name))
+            if stat.S_ISDIR(info.st_mode):
+                paths.append(name)
+            elif not stats:
+                files.append(name)
             else:
+                info = os.stat('%s/%s' % (path, name)) if stat.S_ISLNK(info.st_mode) else info
+                if stat.S_ISREG(info.st_mode):
+                    files.append((name, info))
+
+    return path, paths, files
+
+
+def scan_local(roots, descend, workers=1, stats=False):
+    procs = multiprocessing.pool.ThreadPool(processes=max(1, workers))
+    paths, files = [], []
+    todo = list(i for i in roots if os.path.isdir(i))
+
+    try:
+        while todo:
+            found, todo = procs.map(lambda i: list_local(i, stats), todo), []
+            for path, dirs, names in found:
+                if stats:
+                    files.extend(('%s/%s' % (path, i), j) for i, j in names)
+                else:
+                    files.extend('%s/%s' % (path, i) for i in names)
+                for name in dirs:
+                    full = '%s/%s' % (path, name)
+                    paths.append(full)
+                    if descend(full):
+                        todo.append(full)
+    finally:
+        procs.close()
+        procs.join()
+
+    LOG.debug('scanned %d local directories and %d local files', len(paths), len(files))
+    return paths, files
+
+
+def clean_local(index, local, mirror, unpack, skip=False, workers=1):
+    mirrored = set(i.fullname for i in local.values())
+    unpacked = set(i.zip_path for i in local.values() if i.zip_path)
+    parents = set()
+
+    for path in unpacked:
+        path = os.path.dirname(path)
+        while path.startswith('%s/' % unpack) and path not in parents:
+            parents.add(path)
+            path = os.path.dirname(path)
+
+    inside = lambda path, root: path.startswith('%s/' % root)
+    paths, files = scan_local([mirror, unpack], lambda i: not inside(i, unpack) or i in parents, workers)
+    removed = 0
+
+    for full in files:
+        if inside(full, mirror) and full not in mirrored:
+            LOG.info('removing orphaned local file: %s', full)
+            removed += 1
+            if not skip:
+                os.unlink(full)
+
+    for full in sorted(paths, key=lambda i: i.count('/'), reverse=True):
+        if inside(full, unpack):
+            if full not in unpacked and full not in parents:
                 LOG.info('removing orphaned unpacked local directory: %s', full)
+                removed += 1
                 if not skip:
-                    shutil.rmtree(full)
+                    happy.trash.discard(full)
+        elif inside(full, mirror) and not skip:
+            try:
+                os.rmdir(full)
+                LOG.info('removed orphaned local empty directory: %s', full)
+                removed += 1
+            except OSError as e:
+                if e.errno != errno.ENOTEMPTY:
+                    raise e
+
+    return removed
+
+
+def clean_partial(part, avail, skip=False):
+    for name in os.listdir(part) if os.path.isdir(part) else []:
+        full = '%s/%s' % (part, name)
+        base = full[:-len('.json')] if full.endswith('.json') else full
+        if os.path.isdir(full):
+            continue
+
+        try:
+            if json.load(open('%s.json' % base))['path'] in avail:
+                continue
+        except (IOError, KeyError, ValueError):
+            pass
+
+        LOG.info('removing stale partial download: %s', full)
+        if not skip:
+            try:
+                os.unlink(full)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    happy.log_error(e)
@@ -1,5 +1,12 @@
 import errno
+import happy.archive
+import happy.client
 import happy.parser
+import happy.state
+import happy.trash
+import hashlib
+import httplib
+import json
 import logging
 import os
 import re
@@ -7,60 +14,185 @@ import shutil
 import stat
 import subprocess
 import tempfile
+import threading
 import time
 
 LOG = logging.getLogger()
 
 
+def execute(cmd, cwd=None, timeout=0):
+    proc = subprocess.Popen(cmd, cwd=cwd)
+    timer = threading.Timer(timeout, proc.kill) if timeout else None
+
+    if timer:
+        timer.start()
+    try:
+        code = proc.wait()
+    finally:
+        if timer:
+            timer.cancel()
+
+    if code:
+        raise subprocess.CalledProcessError(code, cmd)
+
+
+def link_tree(source, target):
+    for path, paths, files in os.walk(source):
+        base = target + path[len(source):]
+        for name in paths:
+            full = '%s/%s' % (path, name)
+            if os.path.islink(full):
+                os.symlink(os.readlink(full), '%s/%s' % (base, name))
+            else:
+                os.mkdir('%s/%s' % (base, name))
+                shutil.copymode(full, '%s/%s' % (base, name))
+        for name in files:
+            full = '%s/%s' % (path, name)
+            if os.path.islink(full):
+                os.symlink(os.readlink(full), '%s/%s' % (base, name))
+            else:
+                os.link(full, '%s/%s' % (base, name))
+
+
+class PartialFile(object):
+    def __init__(self, path, remote, size, date, chunk=0):
+        self.name = '%s/%s' % (path, hashlib.sha1(remote).hexdigest())
+        self.meta = '%s.json' % self.name
+        self.info = {'path': remote, 'size': size, 'date': date, 'chunk': chunk}
+        self.lock = threading.Lock()
+        self.written = {}
+
+    @property
+    def size(self):
+        return self.info['size']
+
+    @property
+    def bytes(self):
+        return sum(self.written.values())
+
+    def open(self):
+        try:
+            info = json.load(open(self.meta))
+            if all(info.get(k) == v for k, v in self.info.items()) and os.path.getsize(self.name) == self.size:
+                self.written = dict((int(k), v) for k, v in info['written'].items())
+                LOG.info('resuming partial download of %s at %d of %d bytes', self.info['path'], self.bytes, self.size)
+                return self
+            else:
+                LOG.info('discarding stale partial download of %s', self.info['path'])
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                happy.log_error(e)
+        except (KeyError, ValueError) as e:
+            happy.log_error(e, '%s: corrupt partial download state' % self.meta)
+
+        with open(self.name, 'wb') as data:
+            data.truncate(self.size)
+            self.save(data, 0, 0)
+        LOG.debug('created partial download file: %s', self.name)
+
+        return self
+
+    def save(self, data, offset, count):
+        data.flush()
+        os.fsync(data.fileno())
+
+        with self.lock:
+            self.written[offset] = max(count, self.written.get(offset, 0))
+            with open('%s.tmp' % self.meta, 'w') as meta:
+                json.dump(dict(self.info, written=self.written, bytes=self.bytes), meta)
+            os.rename('%s.tmp' % self.meta, self.meta)
+
+    def remove(self):
+        for name in (self.meta, self.name):
+            try:
+                os.remove(name)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    happy.log_error(e)
+
+
+def prefix(path):
+    return intern(path) if isinstance(path, str) else path
+
+
 class SyncFile(object):
-    _archive_suffixes = {
-        '.zip':     'unzip',
-        '.txz':     'tarxz',
-        '.tar.xz':  'tarxz',
-        '.tgz':     'targz',
-        '.tar.gz':  'targz',
-        '.tbz2':    'tarbz2',
-        '.tar.bz2': 'tarbz2',
-    }
-    _archive_commands = {
-        'unzip':  ['unzip', '-qq'],
-        'targz':  ['tar', '-xzf'],
-        'tarxz':  ['tar', '-xJf'],
-        'tarbz2': ['tar', '-xjf'],
-    }
-
-    def __init__(self, remote, source, mirror, unpack):
+    __slots__ = ('remote', 'source', '_mirror', '_unpack', 'checksum', 'fullname', 'zip_path', 'zip_kind')
+
+    _archive_suffixes = (
+        ('.zip',     'unzip'),
+        ('.txz',     'tarxz'),
+        ('.tar.xz',  'tarxz'),
+        ('.tgz',     'targz'),
+        ('.tar.gz',  'targz'),
+        ('.tbz2',    'tarbz2'),
+        ('.tar.bz2', 'tarbz2'),
+    )
+
+    def __init__(self, remote, source, mirror, unpack, checksum=None):
         self.remote = remote
-        self.source = source
-        self.mirror = mirror
-        self.unpack = unpack
+        self.source = prefix(source)
+        self._mirror = prefix(mirror)
+        self._unpack = prefix(unpack)
+        self.checksum = checksum
+        self.derive()
 
-    @property
-    def fullname(self):
-        return self.mirror + self.remote.full[len(self.source):]
+    def __getstate__(self):
+        return {'remote': self.remote, 'source': self.source, 'mirror': self.mirror, 'unpack': self.unpack, 'checksum': self.checksum}
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            state = dict(state[0] or {}, **state[1])
+
+        remote = state['remote']
+        if not isinstance(remote, happy.client.RemoteFile):
+            remote = happy.client.RemoteFile(remote.full, remote.size, time.mktime(remote.date.timetuple()))
+
+        self.__init__(remote, state['source'], state.get('mirror', state.get('_mirror')), state.get('unpack', state.get('_unpack')), state.get('checksum'))
+
+    def derive(self):
+        rel = self.remote.full[len(self.source):]
+
+        self.fullname = self._mirror + rel
+        self.zip_path = None
+        self.zip_kind = None
+
+        for e, t in self._archive_suffixes:
+            if rel.endswith(e):
+                self.zip_path = self._unpack + rel[:-len(e)]
+                self.zip_kind = t
+                break
 
     @property
-    def zip_path(self):
-        for e, t in self._archive_suffixes.items():
-            if self.fullname.endswith(e):
-                return self.unpack + self.remote.full[len(self.source):-len(e)]
+    def mirror(self):
+        return self._mirror
+
+    @mirror.setter
+    def mirror(self, path):
+        self._mirror = prefix(path)
+        self.derive()
 
     @property
-    def zip_exec(self):
-        for e, t in self._archive_suffixes.items():
-            if self.fullname.endswith(e):
-                return self._archive_commands[t]
+    def unpack(self):
+        return self._unpack
+
+    @unpack.setter
+    def unpack(self, path):
+        self._unpack = prefix(path)
+        self.derive()
 
     @property
-    def filetime(self, other=None):
-        return time.mktime(self.remote.date.timetuple())
+    def filetime(self):
+        return self.remote.mtime
 
     @property
     def modified(self):
-        return not os.path.exists(self.fullname) or self.filetime < os.stat(self.fullname).st_mtime
+        try:
+            return self.filetime < os.stat(self.fullname).st_mtime
+        except OSError:
+            return True
 
     def equal(self, item):
-        return self.remote.size == item.remote.size and self.remote.date == item.remote.date
+        return self.remote.size == item.remote.size and self.remote.mtime == item.remote.mtime
 
     def mkdir(self, path=None):
         try:
@@ -97,7 +229,7 @@ class SyncFile(object):
 
         try:
             if self.zip_path:
-                shutil.rmtree(self.zip_path)
+                happy.trash.discard(self.zip_path)
                 LOG.info('purged local unpacked directory: %s', self.zip_path)
 
                 self.rmdir(self.zip_path)
@@ -111,111 +243,194 @@ class SyncFile(object):
             if isinstance(e, OSError) and e.errno != errno.ENOENT:
                 happy.log_error(e)
 
-    def unzip(self, temp):
+    def unzip(self, temp, data=None):
         path = self.zip_path
         if not path:
             return
 
-        data = tempfile.mkdtemp(dir=temp)
-        save = '%s.__%s__' % (path, os.path.basename(data))
         try:
-            LOG.debug('created temporary unpack path: %s', data)
+            if data is None:
+                data = tempfile.mkdtemp(dir=temp)
+                LOG.debug('created temporary unpack path: %s', data)
 
-            os.chdir(data)
-            subprocess.check_call(self.zip_exec + [self.fullname])
+                happy.archive.extract(self.zip_kind, self.fullname, data)
             LOG.debug('unpacked %s into %s', self.fullname, data)
 
+            save = '%s.__%s__' % (path, os.path.basename(data))
             self.mkdir(path)
 
             os.rename(path, save)
             os.rename(data, path)
-            shutil.rmtree(save)
+            happy.trash.discard(save)
 
             LOG.info('moved unpacked path %s to %s', data, path)
         except Exception as e:
             happy.log_error(e)
+            if data and os.path.exists(data):
+                shutil.rmtree(data, ignore_errors=True)
+
+    def remote_checksum(self, hdfs):
+        try:
+            return hdfs.checksum(self.remote.full)
+        except (RuntimeError, IOError, KeyError, ValueError, httplib.HTTPException) as e:
+            LOG.warning('failed to get hdfs checksum of %s, fetching without it: %s', self.remote.full, e)
 
-    def fetch(self, hdfs, temp=tempfile.gettempdir(), skip=False):
+    def touch(self, last):
+        try:
+            info = os.stat(self.fullname)
+        except OSError as e:
+            LOG.debug('failed to stat local file %s: %s', self.fullname, e)
+            return False
+
+        if info.st_size != last.remote.size or info.st_mtime != last.filetime:
+            LOG.debug('local file %s changed since it was indexed, fetching %s', self.fullname, self.remote.full)
+            return False
+
+        if info.st_nlink > 1:
+            data = tempfile.mktemp(dir=os.path.dirname(self.fullname))
+            shutil.copy2(self.fullname, data)
+            os.rename(data, self.fullname)
+            LOG.debug('separated hardlinked local file before updating metadata: %s', self.fullname)
+
+        os.utime(self.fullname, (self.filetime, self.filetime))
+        LOG.info('updated metadata of unchanged hdfs file: %s', self.remote.full)
+        return True
+
+    def link(self, other, temp):
+        data = tempfile.mktemp(dir=temp)
+        try:
+            os.link(other.fullname, data)
+            info = os.stat(data)
+            if info.st_size != self.remote.size or info.st_mtime != self.filetime:
+                LOG.debug('local copy %s changed while linking, fetching %s', other.fullname, self.remote.full)
+                os.unlink(data)
+                return False
+
+            self.mkdir(os.path.dirname(self.fullname))
+            os.rename(data, self.fullname)
+            LOG.info('linked hdfs file %s to identical local copy: %s', self.remote.full, other.fullname)
+        except OSError as e:
+            LOG.debug('failed to link local copy %s: %s', other.fullname, e)
+            if os.path.exists(data):
+                os.unlink(data)
+            return False
+
+        if self.zip_path and other.zip_path and os.path.isdir(other.zip_path):
+            data = tempfile.mkdtemp(dir=temp)
+            try:
+                link_tree(other.zip_path, data)
+                LOG.debug('linked unpacked path %s into %s', other.zip_path, data)
+            except OSError as e:
+                LOG.debug('failed to link unpacked path %s: %s', other.zip_path, e)
+                shutil.rmtree(data, ignore_errors=True)
+                data = None
+            self.unzip(temp, data)
+        else:
+            self.unzip(temp)
+
+        return True
+
+    def fetch(self, hdfs, temp=tempfile.gettempdir(), skip=False, part=None, unpack=None, last=None, checksum=False, copies=None, peers=None):
         if skip:
             LOG.info('fetching hdfs file: %s', self.remote.full)
             return True
 
         try:
-            with tempfile.NamedTemporaryFile(dir=temp, delete=False) as data:
-                LOG.debug('created temp file: %s', data.name)
+            if checksum:
+                self.checksum = self.remote_checksum(hdfs)
+                if self.checksum and last is not None and last.checksum == self.checksum and self.touch(last):
+                    return True
 
-                hdfs.get(self.remote.full, data=data)
-                LOG.info('fetched hdfs file: %s', self.remote.full)
+            if copies and not self.checksum and copies.candidates(self):
+                self.checksum = self.remote_checksum(hdfs)
+
+            other = copies.find(self) if copies else None
+            if other and self.link(other, temp):
+                copies.saved(self)
+                return True
+
+            data = PartialFile(part or temp, self.remote.full, self.remote.size, self.filetime, hdfs.layout(self.remote.size)).open()
+            sink = happy.archive.stream(self.zip_kind, temp) if self.zip_path and not unpack and not data.bytes and not hdfs.split(data.size) else None
+
+            try:
+                if not peers or not peers.fetch(self, data, sink):
+                    hdfs.fetch(self.remote.full, data, sink)
+                    LOG.info('fetched hdfs file: %s', self.remote.full)
+            except Exception:
+                if sink:
+                    sink.abort()
+                raise
 
             self.mkdir(os.path.dirname(self.fullname))
 
             os.chmod(data.name, os.stat(data.name).st_mode|stat.S_IRGRP|stat.S_IROTH)
             os.utime(data.name, (self.filetime, self.filetime))
             os.rename(data.name, self.fullname)
+            data.remove()
 
-            self.unzip(temp)
+            if unpack and self.zip_path:
+                unpack.submit(self)
+            else:
+                self.unzip(temp, sink and sink.close())
 
             LOG.debug('renamed temp file from %s to %s', data.name, self.fullname)
             return True
         except Exception as e:
             happy.log_error(e)
-            if os.path.exists(data.name):
-                try:
-                    os.remove(data.name)
-                except Exception as e:
-                    happy.log_error(e)
 
-    def check(self, cmds, last, skip=False):
+    def check(self, cmds, last, skip=False, workers=1, timeout=0):
         if skip:
             LOG.info('processing dataset manifest: %s', self.fullname)
             return True
 
         try:
-            data = happy.parser.parse(self.fullname)
-            LOG.info('processing %d items from manifest: %s', len(data), self.fullname)
-
-            for path, paths, files in os.walk(os.path.dirname(self.fullname)):
-                for name in files:
-                    full = '%s/%s' % (path, name)
-                    part = full[len(os.path.dirname(self.fullname))+1:]
-                    info = os.stat(full)
-
-                    if full == self.fullname or stat.S_ISLNK(info.st_mode):
-                        continue
-
-                    if part not in data:
-                        LOG.warning('  file not found in manifest, skipping: %s', full)
-                    else:
-                        data[part]['stat'] = os.stat(full)
-
-
-            find = list(i for i, j in data.items() if 'stat' not in j)
-            if find:
-                LOG.warning('  manifest is missing %d file(s), aborting:', len(find))
-                for item in find:
-                    LOG.warning('    %s', item)
+            root = os.path.dirname(self.fullname)
+            disk = dict((i[len(root) + 1:], (j.st_size, j.st_mtime)) for i, j in happy.state.scan_local([root], lambda i: True, workers, True)[1] if i != self.fullname)
+            seen = missing = invalid = updated = 0
+            done = set()
+
+            for part, size in happy.parser.parse(self.fullname):
+                if part in done:
+                    continue
+
+                seen += 1
+                info = disk.pop(part, None)
+                if info is not None:
+                    done.add(part)
+
+                if info is None:
+                    LOG.warning('    missing: %s', part)
+                    missing += 1
+                elif info[0] != size:
+                    LOG.warning('    invalid: %s (expected: %d bytes, observed: %d bytes)', part, size, info[0])
+                    invalid += 1
+                elif info[1] > last:
+                    updated += 1
+
+            LOG.info('processed %d items from manifest: %s', seen, self.fullname)
+            for part in disk:
+                LOG.warning('  file not found in manifest, skipping: %s/%s', root, part)
+
+            if missing:
+                LOG.warning('  manifest is missing %d file(s), aborting', missing)
                 return False
 
-            find = list(i for i, j in data.items() if j['size'] != j['stat'].st_size)
-            if find:
-                LOG.warning('  manifest has %d invalid file(s), aborting:', len(find))
-                for item in find:
-                    LOG.warning('    %s (expected: %d bytes, observed: %d bytes)', item, data[item]['size'], data[item]['stat'].st_size)
+            if invalid:
+                LOG.warning('  manifest has %d invalid file(s), aborting', invalid)
                 return False
 
-            find = list(i for i, j in data.items() if j['stat'].st_mtime > last)
-            if not find and os.stat(self.fullname).st_mtime < last:
+            if not updated and os.stat(self.fullname).st_mtime < last:
                 LOG.info( '  manifest has no updates, skipping')
                 return True
 
-            os.chdir(os.path.dirname(self.fullname))
+            fail = False
             for item in cmds:
                 try:
-                    subprocess.check_call([item, self.fullname])
+                    execute([item, self.fullname], root, timeout)
                     LOG.info('  executed dataset manifest command: %s %s', item, self.fullname)
-                except (AttributeError, TypeError, subprocess.CalledProcessError) as e:
-                    # FIXME: do something when command fails to allow retries
-                    happy.log_error(e)
-            return True
+                except (AttributeError, TypeError, OSError, subprocess.CalledProcessError) as e:
+                    happy.log_error(e, '  failed dataset manifest command: %s %s' % (item, self.fullname))
+                    fail = True
+            return not fail
         except Exception as e:
             happy.log_error(e)
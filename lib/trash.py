@@ -0,0 +1,111 @@
+import errno
+import happy.scheduler
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+LOG = logging.getLogger()
+
+REAPER = None
+
+
+def setup_trash(path, rate=0):
+    global REAPER
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+        LOG.info('created trash path: %s', path)
+
+    REAPER = Reaper(path, rate)
+    return REAPER
+
+
+def discard(path):
+    if REAPER:
+        REAPER.discard(path)
+    else:
+        shutil.rmtree(path)
+
+
+class Reaper(object):
+    def __init__(self, path, rate=0):
+        self.path = path
+        self.meter = happy.scheduler.Meter(rate)
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.closing = False
+        self.stats = {'trashed': 0, 'removed': 0, 'failed': 0}
+
+        self.thread = threading.Thread(target=self.run, name='reaper')
+        self.thread.daemon = True
+        self.thread.start()
+        self.wake.set()
+
+    def discard(self, path):
+        data = tempfile.mktemp(dir=self.path)
+        try:
+            os.rename(path, data)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            LOG.warning('trash path is on another device, removing in place: %s', path)
+            shutil.rmtree(path)
+            return
+
+        with self.lock:
+            self.stats['trashed'] += 1
+
+        LOG.debug('moved %s to trash: %s', path, data)
+        self.wake.set()
+
+    def run(self):
+        while not self.closing:
+            self.wake.wait(1)
+            self.wake.clear()
+
+            for name in sorted(os.listdir(self.path)):
+                if self.closing:
+                    break
+                self.reap(os.path.join(self.path, name))
+
+    def remove(self, func, path):
+        self.meter.consume(1)
+        if self.closing:
+            return False
+
+        try:
+            func(path)
+            with self.lock:
+                self.stats['removed'] += 1
+        except OSError as e:
+            LOG.debug('failed to reap trashed path %s: %s', path, e)
+            with self.lock:
+                self.stats['failed'] += 1
+        return True
+
+    def reap(self, path):
+        if os.path.islink(path) or not os.path.isdir(path):
+            return self.remove(os.unlink, path)
+
+        for root, paths, files in os.walk(path, topdown=False):
+            for name in files:
+                if not self.remove(os.unlink, os.path.join(root, name)):
+                    return
+            for name in paths:
+                full = os.path.join(root, name)
+                if not self.remove(os.unlink if os.path.islink(full) else os.rmdir, full):
+                    return
+        if not self.remove(os.rmdir, path):
+            return
+
+        LOG.debug('reaped trashed path: %s', path)
+
+    def close(self):
+        # leftovers are reaped by the next start, only finish the current entry
+        self.closing = True
+        self.wake.set()
+        self.thread.join()
+
+        LOG.info('trashed %d paths and reaped %d entries with %d failures', self.stats['trashed'], self.stats['removed'], self.stats['failed'])
@@ -16,5 +16,6 @@ if __name__ == '__main__':
         package_dir={'happy': 'lib'},
         data_files=('/etc/happy', ['dataset.yaml.example']),
         license='LICENSE.txt',
-        install_requires=['json', 'yaml', 'webhdfs', 'setuptools']
+        install_requires=['PyYAML', 'setuptools'],
+        extras_require={'fast': ['ijson', 'scandir']}
     )